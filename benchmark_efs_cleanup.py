@@ -0,0 +1,688 @@
+import os
+import sys
+import csv
+import gzip
+import hashlib
+import io
+import json
+import queue
+import time
+import random
+import shutil
+import argparse
+import datetime
+import tempfile
+import traceback
+import resource
+import importlib.util
+import importlib.machinery
+import multiprocessing
+from contextlib import redirect_stdout
+from urllib.parse import quote_plus
+
+try:
+    import pyarrow
+    import pyarrow.orc as pyarrow_orc
+    import pyarrow.parquet as pyarrow_parquet
+except ImportError:
+    pyarrow = None
+
+# Benchmark harness for the EFS cleanup Lambdas. Every handler runs in a
+# fresh process against its own copy of a synthetic log tree, with S3
+# replaced by an in-memory stand-in serving a gzip CSV inventory, or with
+# --inventory-format a Parquet or ORC one (needs pyarrow).
+#
+#   python benchmark_efs_cleanup.py --files 20000 --depth 3 --fanout 8
+#   python benchmark_efs_cleanup.py --inventory-rows 2000000
+#   python benchmark_efs_cleanup.py --inventory-files 4 --inventory-format ORC \
+#       --inventory-mode merge --handlers crm_core crm_subsys
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+INVENTORY_BUCKET = "benchmark-inventory"
+INVENTORY_PREFIX = "inventory/"
+INVENTORY_KEY = INVENTORY_PREFIX + "data/benchmark.csv.gz"
+BACKUP_BUCKET = "benchmark-backup"
+INVENTORY_SCHEMA = ["Bucket", "Key", "Size", "LastModifiedDate", "ETag"]
+# fileSchema as S3 Inventory writes it into the manifest for each format.
+COLUMNAR_SCHEMAS = {
+    "Parquet": (
+        "message s3.inventory { required binary bucket (STRING); "
+        "required binary key (STRING); optional int64 size; "
+        "optional int64 last_modified_date (TIMESTAMP(MILLIS,true)); "
+        "optional binary e_tag (STRING);}"
+    ),
+    "ORC": (
+        "struct<bucket:string,key:string,size:bigint,"
+        "last_modified_date:timestamp,e_tag:string>"
+    ),
+}
+
+# name -> (source file, needs the S3 inventory stand-in, uses ctime)
+HANDLERS = {
+    "crm_core": ("crm_core_log_cleanup.py", True, False),
+    "crm_subsys": ("crm_subsys_log_cleanup.py", True, False),
+    "verify": ("verify_s3_delete_90days_gz.py", True, False),
+    "subsys_verify": ("subsys_verify_s3_delete_90days_gz.py", True, False),
+    "archive_qa": ("delete_log_archive_qa.py", False, True),
+    "delete_gz_txt": ("Delete GZ Lambda.txt", False, True),
+    "delete_7_days_txt": (
+        "Lambda Function for Delete 7 Days LOgs.txt", False, True
+    ),
+}
+
+METADATA_CALLS = (
+    "stat", "lstat", "scandir", "listdir", "remove", "unlink", "rmdir",
+)
+
+
+class ListObjectsPaginator:
+    def __init__(self, objects):
+        self.objects = objects
+
+    def paginate(self, Bucket, Prefix="", **kwargs):
+        contents = [
+            {
+                "Key": key,
+                "Size": len(body),
+                "LastModified": modified,
+                "ETag": '"benchmark"',
+            }
+            for (bucket, key), (body, modified) in sorted(self.objects.items())
+            if bucket == Bucket and key.startswith(Prefix)
+        ]
+        for start in range(0, max(len(contents), 1), 1000):
+            yield {"Contents": contents[start:start + 1000]}
+
+
+# Just enough of the boto3 S3 client surface for the cleanup handlers.
+class LocalS3:
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.calls = {}
+        self.not_found = KeyError
+
+    def count(self, operation):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def put(self, bucket, key, body):
+        self.objects[(bucket, key)] = (
+            body, datetime.datetime.now(datetime.timezone.utc)
+        )
+
+    def get_paginator(self, operation):
+        self.count(operation)
+        return ListObjectsPaginator(self.objects)
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.count("head_object")
+        if (Bucket, Key) not in self.objects:
+            raise self.not_found(f"NoSuchKey: s3://{Bucket}/{Key}")
+        body, modified = self.objects[(Bucket, Key)]
+        return {
+            "ContentLength": len(body),
+            "LastModified": modified,
+            "ETag": f'"{hashlib.md5(body).hexdigest()}"',
+        }
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self.count("get_object")
+        if (Bucket, Key) not in self.objects:
+            raise KeyError(f"NoSuchKey: s3://{Bucket}/{Key}")
+        body, modified = self.objects[(Bucket, Key)]
+        return {
+            "Body": io.BytesIO(body),
+            "ContentLength": len(body),
+            "LastModified": modified,
+            "ETag": '"benchmark"',
+        }
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.count("put_object")
+        if isinstance(Body, str):
+            Body = Body.encode("utf-8")
+        self.put(Bucket, Key, Body)
+        return {"ETag": '"benchmark"'}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self.count("create_multipart_upload")
+        upload_id = str(len(self.uploads) + 1)
+        self.uploads[upload_id] = []
+        return {"UploadId": upload_id}
+
+    def upload_part(self, UploadId, PartNumber, Body, **kwargs):
+        self.count("upload_part")
+        self.uploads[UploadId].append((PartNumber, Body))
+        return {"ETag": f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self.count("complete_multipart_upload")
+        parts = sorted(self.uploads.pop(UploadId))
+        self.put(Bucket, Key, b"".join(body for _, body in parts))
+        return {}
+
+
+class FakeContext:
+    def __init__(self, timeout_seconds):
+        self.deadline = time.time() + timeout_seconds
+        self.aws_request_id = "benchmark"
+        self.function_name = "benchmark"
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.time()) * 1000)
+
+
+def build_tree(root, args):
+    rng = random.Random(args.seed)
+    now = time.time()
+    payload = b"x" * args.file_size
+
+    leaves = [""]
+    for level in range(args.depth):
+        leaves = [
+            os.path.join(parent, f"d{level}-{child:03d}")
+            for parent in leaves
+            for child in range(args.fanout)
+        ]
+
+    rows = []
+    for index in range(args.files):
+        if rng.random() < args.old_fraction:
+            age_days = rng.uniform(args.retention_days + 1, args.max_age_days)
+        else:
+            age_days = rng.uniform(0, args.retention_days - 1)
+        mtime = now - age_days * 86400
+
+        directory = os.path.join(root, leaves[index % len(leaves)])
+        if args.date_layout:
+            directory = os.path.join(
+                directory, time.strftime("%Y/%m/%d", time.gmtime(mtime))
+            )
+        os.makedirs(directory, exist_ok=True)
+        suffix = ".log" if rng.random() < args.non_gz_fraction else ".log.gz"
+        path = os.path.join(directory, f"f{index:08d}{suffix}")
+        with open(path, "wb") as f:
+            f.write(payload)
+        os.utime(path, (mtime, mtime))
+
+        if rng.random() < args.inventory_coverage:
+            rows.append((os.path.relpath(path, root), len(payload), mtime))
+
+    return rows
+
+
+def build_csv(rows, header, url_encode):
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb") as gz:
+        text = io.TextIOWrapper(gz, encoding="utf-8", newline="")
+        # S3 Inventory quotes every field of its data files.
+        writer = csv.writer(
+            text, quoting=csv.QUOTE_ALL if url_encode else csv.QUOTE_MINIMAL
+        )
+        if header:
+            writer.writerow(INVENTORY_SCHEMA)
+        for key, size, mtime in rows:
+            modified = datetime.datetime.fromtimestamp(
+                mtime, datetime.timezone.utc
+            ).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+            if url_encode:
+                key = quote_plus(key, safe="/")
+            writer.writerow(["efs-backup", key, size, modified, "benchmark"])
+        text.flush()
+        text.detach()
+    return buffer.getvalue()
+
+
+# Parquet and ORC data files hold the keys as plain strings (no URL
+# encoding) in snake_case columns.
+def build_columnar(rows, file_format):
+    table = pyarrow.table({
+        "bucket": ["efs-backup"] * len(rows),
+        "key": [key for key, _, _ in rows],
+        "size": pyarrow.array([size for _, size, _ in rows], pyarrow.int64()),
+        "last_modified_date": pyarrow.array(
+            [int(mtime * 1000) for _, _, mtime in rows],
+            pyarrow.timestamp("ms", tz="UTC")
+        ),
+        "e_tag": ["benchmark"] * len(rows),
+    })
+    buffer = io.BytesIO()
+    if file_format == "Parquet":
+        pyarrow_parquet.write_table(table, buffer, row_group_size=100000)
+    else:
+        pyarrow_orc.write_table(table, buffer)
+    return buffer.getvalue()
+
+
+# Returns {key: body} for the inventory objects. With data_files set (or a
+# columnar file_format), the rows are split across that many header-less
+# data files behind a dated manifest.json, the way S3 Inventory delivers
+# them; otherwise a single CSV with a header row is written.
+def build_inventory(rows, data_files=0, file_format="CSV"):
+    rows = sorted(rows)
+    if file_format != "CSV":
+        if pyarrow is None:
+            raise Exception(f"pyarrow is required to write {file_format} inventories")
+        data_files = data_files or 1
+    if not data_files:
+        return {INVENTORY_KEY: build_csv(rows, True, False)}
+
+    objects = {}
+    entries = []
+    per_file = -(-len(rows) // data_files) or 1
+    for index, start in enumerate(range(0, max(len(rows), 1), per_file)):
+        if file_format == "CSV":
+            key = f"{INVENTORY_PREFIX}data/benchmark-{index}.csv.gz"
+            body = build_csv(rows[start:start + per_file], False, True)
+        else:
+            key = f"{INVENTORY_PREFIX}data/benchmark-{index}.{file_format.lower()}"
+            body = build_columnar(rows[start:start + per_file], file_format)
+        objects[key] = body
+        entries.append({
+            "key": key,
+            "size": len(body),
+            "MD5checksum": hashlib.md5(body).hexdigest(),
+        })
+
+    run = datetime.datetime.now(datetime.timezone.utc).strftime(
+        "%Y-%m-%dT01-00Z"
+    )
+    manifest = json.dumps({
+        "sourceBucket": "efs-backup",
+        "destinationBucket": f"arn:aws:s3:::{INVENTORY_BUCKET}",
+        "fileFormat": file_format,
+        "fileSchema": COLUMNAR_SCHEMAS.get(
+            file_format, ", ".join(INVENTORY_SCHEMA)
+        ),
+        "files": entries,
+    }).encode("utf-8")
+    objects[f"{INVENTORY_PREFIX}{run}/manifest.json"] = manifest
+    objects[f"{INVENTORY_PREFIX}{run}/manifest.checksum"] = (
+        hashlib.md5(manifest).hexdigest().encode("utf-8")
+    )
+    return objects
+
+
+# Counts every metadata call that goes through the os module, including
+# the stat() calls made on DirEntry objects handed out by os.scandir.
+class CountingEntry:
+    def __init__(self, entry, counters):
+        self._entry = entry
+        self._counters = counters
+
+    def __getattr__(self, name):
+        return getattr(self._entry, name)
+
+    def __fspath__(self):
+        return self._entry.path
+
+    def stat(self, *args, **kwargs):
+        self._counters["stat"] += 1
+        return self._entry.stat(*args, **kwargs)
+
+
+class CountingScandir:
+    def __init__(self, iterator, counters):
+        self._iterator = iterator
+        self._counters = counters
+
+    def __iter__(self):
+        return (CountingEntry(entry, self._counters) for entry in self._iterator)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._iterator.close()
+
+
+def install_counters(counters, first_delete):
+    for name in METADATA_CALLS:
+        original = getattr(os, name)
+
+        def counted(*args, _name=name, _original=original, **kwargs):
+            counters[_name] += 1
+            if _name in ("remove", "unlink") and not first_delete:
+                first_delete.append(time.perf_counter())
+            result = _original(*args, **kwargs)
+            if _name == "scandir":
+                return CountingScandir(result, counters)
+            return result
+
+        setattr(os, name, counted)
+
+
+def load_handler(source):
+    name = "benchmark_" + os.path.splitext(os.path.basename(source))[0]
+    name = "".join(c if c.isalnum() else "_" for c in name)
+    loader = importlib.machinery.SourceFileLoader(
+        name, os.path.join(REPO_DIR, source)
+    )
+    spec = importlib.util.spec_from_loader(name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+# Runs in the spawned process. Any failure, an import error included, is
+# sent back as the result so the parent never waits on a dead child.
+def run_handler(name, root, state_dir, inventory, rows, args, results):
+    try:
+        results.put(measure_handler(name, root, state_dir, inventory, rows, args))
+    except BaseException:
+        results.put({"handler": name, "error": traceback.format_exc()})
+
+
+def measure_handler(name, root, state_dir, inventory, rows, args):
+    source, uses_inventory, uses_ctime = HANDLERS[name]
+    os.environ.update({
+        "EFS_MOUNT_PATH": root,
+        "INVENTORY_BUCKET": INVENTORY_BUCKET,
+        "INVENTORY_PREFIX": INVENTORY_PREFIX,
+        "RETENTION_DAYS": str(args.retention_days),
+        "RH_RETENTION_DAYS": str(args.retention_days),
+        "RH_PREFIX": args.rh_prefix,
+        "CHECKPOINT_PATH": os.path.join(state_dir, f"{name}.checkpoint.json"),
+        "WALKER_WORKERS": str(args.workers),
+        "INVENTORY_CACHE_DIR": state_dir,
+        "BACKUP_BUCKET": BACKUP_BUCKET,
+        "INVENTORY_MODE": args.inventory_mode,
+    })
+    os.environ.pop("REPORT_PATH", None)
+    if args.head_object_threshold is not None:
+        os.environ["HEAD_OBJECT_THRESHOLD"] = str(args.head_object_threshold)
+
+    with redirect_stdout(io.StringIO()):
+        module = load_handler(source)
+
+    if uses_inventory:
+        local_s3 = LocalS3()
+        for key, body in inventory.items():
+            local_s3.put(INVENTORY_BUCKET, key, body)
+        module.s3 = local_s3
+        # The verify handlers confirm small candidate sets with HeadObject
+        # against the backup bucket; every inventory row exists there.
+        if hasattr(module, "head_s3"):
+            for key, size, _ in rows:
+                local_s3.put(BACKUP_BUCKET, key, bytes(size))
+            module.head_s3 = local_s3
+            if hasattr(module, "ClientError"):
+                local_s3.not_found = lambda message: module.ClientError(
+                    {"Error": {"Code": "404", "Message": message}},
+                    "HeadObject"
+                )
+    if hasattr(module, "efs_mount_path"):
+        module.efs_mount_path = root
+    if uses_ctime:
+        # ctime cannot be backdated, so every .gz counts as old here.
+        module.days_threshold_delete = 0
+
+    counters = dict.fromkeys(METADATA_CALLS, 0)
+    first_delete = []
+    install_counters(counters, first_delete)
+
+    context = FakeContext(args.timeout)
+    sink = io.StringIO() if args.quiet_handler else sys.stdout
+    start = time.perf_counter()
+    with redirect_stdout(sink):
+        response = module.lambda_handler({}, context)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "handler": name,
+        "elapsed_seconds": elapsed,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "metadata_calls": counters,
+        "time_to_first_delete": (
+            first_delete[0] - start if first_delete else None
+        ),
+        "response": response,
+    }
+
+
+# Polls the child's queue so that a child that dies without reporting (for
+# example before run_handler starts) or hangs past the timeout is reported
+# as an error instead of blocking the harness.
+def wait_for_result(name, process, results, timeout):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            pass
+        if not process.is_alive():
+            try:
+                return results.get(timeout=1)
+            except queue.Empty:
+                return {
+                    "handler": name,
+                    "error": f"exited with code {process.exitcode} "
+                             f"without a result",
+                }
+        if time.time() > deadline:
+            process.terminate()
+            return {"handler": name, "error": f"timed out after {timeout}s"}
+
+
+def benchmark(name, args):
+    workdir = tempfile.mkdtemp(prefix=f"efs-bench-{name}-")
+    try:
+        root = os.path.join(workdir, "efs")
+        state_dir = os.path.join(workdir, "state")
+        os.makedirs(root)
+        os.makedirs(state_dir)
+        rows = build_tree(root, args)
+        inventory = build_inventory(
+            rows, args.inventory_files, args.inventory_format
+        )
+
+        ctx = multiprocessing.get_context("spawn")
+        results = ctx.Queue()
+        process = ctx.Process(
+            target=run_handler,
+            args=(name, root, state_dir, inventory, rows, args, results),
+        )
+        process.start()
+        result = wait_for_result(name, process, results, args.timeout + 60)
+        process.join()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if "error" in result:
+        return result
+    calls = sum(result["metadata_calls"].values())
+    result["files"] = args.files
+    result["files_per_second"] = args.files / result["elapsed_seconds"]
+    result["metadata_calls_per_file"] = calls / args.files
+    return result
+
+
+# The inventory parser as it was before buffered reading and .gz pushdown:
+# one decode per line and every key kept as a string.
+def parse_inventory_baseline(objects, layout_header):
+    keys = set()
+    for key, body in objects.items():
+        if not key.endswith(".csv.gz"):
+            continue
+        with gzip.GzipFile(fileobj=io.BytesIO(body)) as gz:
+            reader = csv.reader(line.decode("utf-8") for line in gz)
+            if layout_header:
+                next(reader)
+            for row in reader:
+                keys.add(row[1])
+    return keys
+
+
+# Times inventory parsing alone on a synthetic manifest inventory of
+# --inventory-rows rows: the baseline parser (on a CSV inventory), then
+# each handler's cold index build and a warm lookup of the same inventory
+# in --inventory-format. Every index is checked against the rows: it must
+# hold each .gz key and nothing else.
+def benchmark_inventory(args):
+    rng = random.Random(args.seed)
+    now = time.time()
+    rows = [
+        (
+            f"app{index % 8}/{time.strftime('%Y/%m/%d', time.gmtime(now - index))}"
+            f"/host-{index:09d}"
+            f"{'.log' if rng.random() < args.non_gz_fraction else '.log.gz'}",
+            args.file_size,
+            now - index,
+        )
+        for index in range(args.inventory_rows)
+    ]
+    gz_keys = [key for key, _, _ in rows if key.endswith(".gz")]
+    sample = rng.sample(gz_keys, min(len(gz_keys), 10000))
+    absent = [key[:-3] + ".absent.gz" for key in sample]
+    objects = build_inventory(rows, args.inventory_files or 8)
+
+    start = time.perf_counter()
+    parse_inventory_baseline(objects, False)
+    results = [("baseline", time.perf_counter() - start)]
+
+    if args.inventory_format != "CSV":
+        objects = build_inventory(
+            rows, args.inventory_files or 8, args.inventory_format
+        )
+    del rows
+
+    workdir = tempfile.mkdtemp(prefix="efs-bench-inventory-")
+    try:
+        for name in args.handlers:
+            source, uses_inventory, _ = HANDLERS[name]
+            if not uses_inventory:
+                continue
+            os.environ.update({
+                "EFS_MOUNT_PATH": workdir,
+                "INVENTORY_BUCKET": INVENTORY_BUCKET,
+                "INVENTORY_PREFIX": INVENTORY_PREFIX,
+                "RETENTION_DAYS": str(args.retention_days),
+                "RH_RETENTION_DAYS": str(args.retention_days),
+                "RH_PREFIX": args.rh_prefix,
+                "INVENTORY_CACHE_DIR": os.path.join(workdir, name),
+            })
+            with redirect_stdout(io.StringIO()):
+                module = load_handler(source)
+                local_s3 = LocalS3()
+                for key, body in objects.items():
+                    local_s3.put(INVENTORY_BUCKET, key, body)
+                module.s3 = local_s3
+                inventory_key = module.get_latest_inventory_key()
+
+                start = time.perf_counter()
+                index = module.load_inventory_keys(inventory_key)
+                results.append((f"{name} cold", time.perf_counter() - start))
+                if len(index) != len(gz_keys) or not all(
+                    key in index for key in sample
+                ) or any(key in index for key in absent):
+                    raise Exception(
+                        f"{name} indexed {len(index)} keys from the "
+                        f"{args.inventory_format} inventory, expected "
+                        f"{len(gz_keys)}"
+                    )
+
+                module.inventory_indexes.clear()
+                start = time.perf_counter()
+                module.load_inventory_keys(inventory_key)
+                results.append((f"{name} cached", time.perf_counter() - start))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{args.inventory_format} inventory, {len(gz_keys)} .gz keys")
+    print(f"{'parser':<22} {'rows/s':>12} {'elapsed s':>10}")
+    for name, elapsed in results:
+        print(
+            f"{name:<22} {args.inventory_rows / elapsed:>12.0f} "
+            f"{elapsed:>10.3f}"
+        )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the EFS cleanup Lambdas"
+    )
+    parser.add_argument("--files", type=int, default=10000)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fanout", type=int, default=6)
+    parser.add_argument("--file-size", type=int, default=64)
+    parser.add_argument("--old-fraction", type=float, default=0.5)
+    parser.add_argument("--non-gz-fraction", type=float, default=0.1)
+    parser.add_argument("--inventory-coverage", type=float, default=0.9)
+    parser.add_argument(
+        "--inventory-files", type=int, default=0,
+        help="split the inventory across this many manifest data files"
+    )
+    parser.add_argument(
+        "--inventory-format", choices=["CSV", "Parquet", "ORC"],
+        default="CSV"
+    )
+    parser.add_argument(
+        "--inventory-mode", choices=["set", "merge"], default="set",
+        help="INVENTORY_MODE for the crm handlers"
+    )
+    parser.add_argument(
+        "--inventory-rows", type=int, default=0,
+        help="only benchmark inventory parsing, on this many rows"
+    )
+    parser.add_argument("--retention-days", type=int, default=90)
+    parser.add_argument("--max-age-days", type=int, default=400)
+    parser.add_argument(
+        "--date-layout", action="store_true",
+        help="place files under YYYY/MM/DD directories matching their mtime"
+    )
+    parser.add_argument("--rh-prefix", default="rh-")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--timeout", type=int, default=900)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--handlers", nargs="+", choices=sorted(HANDLERS),
+        default=sorted(HANDLERS)
+    )
+    parser.add_argument(
+        "--head-object-threshold", type=int, default=None,
+        help="HEAD_OBJECT_THRESHOLD for the verify handlers"
+    )
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument(
+        "--show-handler-output", dest="quiet_handler", action="store_false"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.inventory_rows:
+        benchmark_inventory(args)
+        return
+
+    results = [benchmark(name, args) for name in args.handlers]
+
+    if args.json:
+        print(json.dumps(results, indent=2, default=str))
+        return
+
+    print(
+        f"{'handler':<18} {'files/s':>10} {'elapsed s':>10} "
+        f"{'peak RSS MB':>12} {'calls/file':>11} {'first delete s':>15}"
+    )
+    for result in results:
+        if "error" in result:
+            error = result["error"].strip().splitlines()[-1]
+            print(f"{result['handler']:<18} failed: {error}")
+            continue
+        first_delete = result["time_to_first_delete"]
+        print(
+            f"{result['handler']:<18} "
+            f"{result['files_per_second']:>10.0f} "
+            f"{result['elapsed_seconds']:>10.2f} "
+            f"{result['peak_rss_mb']:>12.1f} "
+            f"{result['metadata_calls_per_file']:>11.2f} "
+            f"{'-' if first_delete is None else f'{first_delete:.3f}':>15}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+import json
+import time
+import logging
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from benchmark_opensearch_transform import BUCKET, KEY, build_lines, load_handler
+
+# Benchmark for bulk submission in the OpenSearch ingest Lambda, against a
+# local stub of the _bulk API. The stub answers after --latency-ms, rejects
+# every --throttle-every'th request with HTTP 429 and fails each item with
+# es_rejected_execution_exception at --reject-fraction. transform's chunks
+# go through BulkSender at each --concurrency; concurrency 1 is the old
+# one-request-at-a-time behaviour. Every run must index each document once
+# and only once; the lowest concurrency limit and the peak number of
+# requests in flight show AIMD backing off and ramping up again.
+#
+#   python benchmark_opensearch_bulk.py --lines 50000 --concurrency 1 4 8
+#   python benchmark_opensearch_bulk.py --throttle-every 0 --reject-fraction 0
+
+
+class StubBulkServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, args):
+        super().__init__(("127.0.0.1", 0), StubBulkHandler)
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.throttled = 0
+        self.rejected_items = 0
+        self.inflight = 0
+        self.max_inflight = 0
+        self.docs = {}
+
+
+class StubBulkHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        with server.lock:
+            server.requests += 1
+            server.inflight += 1
+            server.max_inflight = max(server.max_inflight, server.inflight)
+            throttle = server.args.throttle_every and server.requests % server.args.throttle_every == 0
+        try:
+            time.sleep(server.args.latency_ms / 1000)
+            if throttle:
+                with server.lock:
+                    server.throttled += 1
+                self.send_response(429)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            items = []
+            with server.lock:
+                for action in body.splitlines()[::2]:
+                    doc_id = json.loads(action)["index"]["_id"]
+                    if server.rng.random() < server.args.reject_fraction:
+                        server.rejected_items += 1
+                        items.append({"index": {"_id": doc_id, "status": 429,
+                                                "error": {"type": "es_rejected_execution_exception"}}})
+                    else:
+                        server.docs[doc_id] = server.docs.get(doc_id, 0) + 1
+                        items.append({"index": {"_id": doc_id, "status": 201}})
+            data = json.dumps({
+                "errors": any(item["index"]["status"] >= 300 for item in items),
+                "items": items,
+            }).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        finally:
+            with server.lock:
+                server.inflight -= 1
+
+
+def run(module, server, chunks, concurrency):
+    module.bulk_concurrency = concurrency
+    server.reset()
+    sender = module.BulkSender()
+    limits = []
+    for name in ("rejected", "accepted"):
+        def traced(method=getattr(sender, name)):
+            method()
+            limits.append(sender.limit)
+        setattr(sender, name, traced)
+
+    source = module.SourceObject(BUCKET, KEY)
+    start = time.perf_counter()
+    try:
+        for chunk in chunks:
+            sender.submit(chunk, source)
+        sender.wait(source)
+    finally:
+        sender.close()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "concurrency": concurrency,
+        "error": None if source.error is None else str(source.error),
+        "elapsed_seconds": elapsed,
+        "requests": server.requests,
+        "throttled_requests": server.throttled,
+        "rejected_items": server.rejected_items,
+        "max_inflight": server.max_inflight,
+        "min_limit": min(limits, default=concurrency),
+        "final_limit": sender.limit,
+        "docs_indexed": len(server.docs),
+        "duplicate_writes": sum(count - 1 for count in server.docs.values()),
+    }
+
+
+def benchmark(args):
+    lines = build_lines(args)
+    module = load_handler(args.source, True)
+    server = StubBulkServer(args)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        # Every 429 and retry is logged as a warning; only failures are shown.
+        module.logger.setLevel(logging.ERROR)
+        module.host = f"http://127.0.0.1:{server.server_port}/_bulk"
+        module.get_awsauth = lambda: None
+        module.spool_bucket = module.spool_dir = None
+        module.bulk_max_retries = args.max_retries
+        module.backoff_base_seconds = args.backoff_base_ms / 1000
+        module.backoff_max_seconds = args.backoff_max_ms / 1000
+        module.bulk_max_inflight_bytes = args.max_inflight_mb * 1024 * 1024
+        module.bulk_max_bytes = args.bulk_max_kb * 1024
+        chunks = list(module.transform(lines, BUCKET, KEY))
+        expected = sum(chunk.count(b"\n") // 2 for chunk in chunks)
+
+        results = []
+        for concurrency in args.concurrency:
+            result = run(module, server, chunks, concurrency)
+            result["docs"] = expected
+            result["chunks"] = len(chunks)
+            result["docs_per_second"] = expected / result["elapsed_seconds"]
+            results.append(result)
+        return results
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark bulk submission in the OpenSearch ingest Lambda against a stub server"
+    )
+    parser.add_argument("--source", default="opensearch_lambda_dev.py")
+    parser.add_argument("--lines", type=int, default=20000)
+    parser.add_argument("--log-size", type=int, default=200)
+    parser.add_argument("--match-fraction", type=float, default=0.9)
+    parser.add_argument("--bulk-max-kb", type=int, default=256)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--throttle-every", type=int, default=5,
+                        help="answer every Nth request with HTTP 429 (0 disables)")
+    parser.add_argument("--reject-fraction", type=float, default=0.02,
+                        help="fraction of items failed with es_rejected_execution_exception")
+    parser.add_argument("--max-retries", type=int, default=8)
+    parser.add_argument("--backoff-base-ms", type=float, default=10)
+    parser.add_argument("--backoff-max-ms", type=float, default=500)
+    parser.add_argument("--max-inflight-mb", type=float, default=4)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = benchmark(args)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    baseline = results[0]["elapsed_seconds"]
+    print(
+        f"{results[0]['docs']} documents in {results[0]['chunks']} chunks\n"
+        f"{'conc':>4} {'docs/s':>9} {'speedup':>8} {'requests':>9} {'429s':>6} "
+        f"{'rejected':>9} {'inflight':>9} {'min limit':>10} {'indexed':>13} {'dupes':>6}"
+    )
+    for result in results:
+        print(
+            f"{result['concurrency']:>4} {result['docs_per_second']:>9.0f} "
+            f"{baseline / result['elapsed_seconds']:>8.2f} {result['requests']:>9} "
+            f"{result['throttled_requests']:>6} {result['rejected_items']:>9} "
+            f"{result['max_inflight']:>9} {result['min_limit']:>10} "
+            f"{result['docs_indexed']:>13} {result['duplicate_writes']:>6}"
+        )
+        if result["error"]:
+            print(f"     failed: {result['error']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import importlib.util
+import importlib.machinery
+
+# Microbenchmark for the per-line cost of transform in the OpenSearch ingest
+# Lambda. A synthetic Fluent Bit style log object is turned into bulk chunks
+# by the original string-building transform (baseline), then by the current
+# transform with the stdlib codec and, when it is installed, with orjson.
+#
+#   python benchmark_opensearch_transform.py --lines 200000
+#   python benchmark_opensearch_transform.py --source os-digital-core.py
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BUCKET = "benchmark-logs"
+KEY = "fluent-bit/2024/01/01/benchmark.log"
+
+
+def build_lines(args):
+    rng = random.Random(args.seed)
+    start = datetime.datetime(2024, 1, 1)
+    lines = []
+    for index in range(args.lines):
+        namespace = f"dte-app{index % 6}" if rng.random() < args.match_fraction else "kube-system"
+        record = {
+            "date": (start + datetime.timedelta(seconds=index)).isoformat() + "Z",
+            "log": f"{index} INFO request handled path=/api/v1/items/{rng.randrange(10**6)} "
+                   + "x" * rng.randrange(args.log_size // 2, args.log_size * 3 // 2),
+            "stream": "stdout",
+            "cluster_name": "benchmark",
+            "kubernetes": {
+                "pod_name": f"app-{index % 50}-7d9c8b",
+                "namespace_name": namespace,
+                "container_name": f"app{index % 6}",
+                "host": f"ip-10-0-{index % 16}-{index % 200}.ec2.internal",
+                "labels": {"app": f"app{index % 6}", "tier": "backend"},
+            },
+        }
+        lines.append(json.dumps(record).encode("utf-8"))
+    return lines
+
+
+# transform as it was before chunking and the codec layer: one str for the
+# whole object, an eager debug f-string and random ids.
+def baseline_transform(module, lines):
+    bulk_request_body = ""
+    unique_id = f"{int(datetime.datetime.now().timestamp())}{random.randint(1, 10**18)}{random.randint(1, 10**18)}"
+    count = -1
+    for k in lines:
+        count += 1
+        if k.strip():
+            try:
+                parsed_data = json.loads(k)
+                module.logger.debug(f"Processing log entry: {json.dumps(parsed_data)}")
+            except json.JSONDecodeError:
+                continue
+            namespace = parsed_data.get('kubernetes', {}).get('namespace_name', '')
+            if 'dte-' in namespace:
+                date = parsed_data.get('date', '').split('T')[0]
+                index_name = f"{module.index_key}{namespace}_{date}"
+                log_line = parsed_data.get('log', '')
+                if not index_name or not log_line:
+                    continue
+                actions = {"index": {"_index": index_name, "_id": f"{unique_id}{count}"}}
+                source = {
+                    "kubernetes": parsed_data.get('kubernetes', {}),
+                    "ms-name": parsed_data.get('kubernetes', {}).get('container_name', ''),
+                    "log": log_line,
+                    "cluster_name": parsed_data.get('cluster_name', ''),
+                    "@id": f"{unique_id}{count}",
+                    "@timestamp": parsed_data.get('date', ''),
+                    "@owner": '',
+                    "@log_group": BUCKET,
+                    "@log_stream": KEY
+                }
+                bulk_request_body += "\n".join([json.dumps(actions), json.dumps(source)]) + "\n"
+            else:
+                module.logger.debug(f"Skipping entry as namespace doesn't match 'dte-': {parsed_data}")
+    return [bulk_request_body.encode("utf-8")]
+
+
+def load_handler(source, with_orjson):
+    os.environ.setdefault("LOG_FAILED_RESPONSES", "false")
+    os.environ.setdefault("INDEX_KEY", "benchmark-")
+    os.environ.setdefault("AWS_REGION", "us-east-1")
+    blocked = sys.modules.get("orjson", False)
+    if not with_orjson:
+        # A None entry makes "import orjson" raise ImportError.
+        sys.modules["orjson"] = None
+    try:
+        name = "benchmark_" + "".join(
+            c if c.isalnum() else "_" for c in os.path.splitext(source)[0]
+        ) + ("_orjson" if with_orjson else "_stdlib")
+        loader = importlib.machinery.SourceFileLoader(
+            name, os.path.join(REPO_DIR, source)
+        )
+        spec = importlib.util.spec_from_loader(name, loader)
+        module = importlib.util.module_from_spec(spec)
+        loader.exec_module(module)
+    finally:
+        if not with_orjson:
+            if blocked is False:
+                del sys.modules["orjson"]
+            else:
+                sys.modules["orjson"] = blocked
+    return module
+
+
+def time_run(run, lines, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chunks = run(lines)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, sum(len(chunk) for chunk in chunks)
+
+
+def benchmark(args):
+    lines = build_lines(args)
+    stdlib_module = load_handler(args.source, False)
+    runs = [
+        ("baseline", lambda lines: baseline_transform(stdlib_module, lines)),
+        ("stdlib", lambda lines: list(stdlib_module.transform(lines, BUCKET, KEY))),
+    ]
+    orjson_module = load_handler(args.source, True)
+    if orjson_module.orjson is not None:
+        runs.append(("orjson", lambda lines: list(orjson_module.transform(lines, BUCKET, KEY))))
+    else:
+        print("orjson is not installed, skipping it")
+
+    results = []
+    for name, run in runs:
+        elapsed, output_bytes = time_run(run, lines, args.repeat)
+        results.append({
+            "codec": name,
+            "lines": len(lines),
+            "elapsed_seconds": elapsed,
+            "ns_per_line": elapsed / len(lines) * 1e9,
+            "lines_per_second": len(lines) / elapsed,
+            "output_bytes": output_bytes,
+        })
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark transform in the OpenSearch ingest Lambda"
+    )
+    parser.add_argument("--source", default="opensearch_lambda_dev.py")
+    parser.add_argument("--lines", type=int, default=100000)
+    parser.add_argument("--log-size", type=int, default=200)
+    parser.add_argument("--match-fraction", type=float, default=0.9)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = benchmark(args)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    baseline = results[0]["ns_per_line"]
+    print(
+        f"{'codec':<10} {'ns/line':>10} {'lines/s':>12} "
+        f"{'speedup':>8} {'output MB':>10}"
+    )
+    for result in results:
+        print(
+            f"{result['codec']:<10} {result['ns_per_line']:>10.0f} "
+            f"{result['lines_per_second']:>12.0f} "
+            f"{baseline / result['ns_per_line']:>8.2f} "
+            f"{result['output_bytes'] / 1e6:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,65 @@ import os
 import boto3
 import csv
 import gzip
+import zlib
+import io
+import json
+import re
+import hashlib
+import heapq
+import mmap
+import uuid
 import time
+import datetime
+import threading
+from array import array
+from bisect import bisect_left
+from collections import deque
+from itertools import islice
+from operator import methodcaller
+from urllib.parse import unquote_to_bytes
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    import pyarrow
+    import pyarrow.compute as pyarrow_compute
+    import pyarrow.orc as pyarrow_orc
+    import pyarrow.parquet as pyarrow_parquet
+except ImportError:
+    pyarrow = None
 
 EFS_MOUNT_PATH = os.environ.get("EFS_MOUNT_PATH")
 INVENTORY_BUCKET = os.environ.get("INVENTORY_BUCKET")
 INVENTORY_PREFIX = os.environ.get("INVENTORY_PREFIX")
 RETENTION_DAYS = os.environ.get("RETENTION_DAYS")
 TIMEOUT_BUFFER_SECONDS = 30
+WALKER_WORKERS = os.environ.get("WALKER_WORKERS", "16")
+REMOVE_EMPTY_DIRS = os.environ.get("REMOVE_EMPTY_DIRS", "false").lower() == "true"
+KEEP_DIRS = {
+    path.strip("/")
+    for path in os.environ.get("KEEP_DIRS", "").split(",")
+    if path.strip("/")
+}
+EMPTY_DIR_BATCH_SIZE = 256
+# Optional fixed cap on EFS metadata operations per second; unset or 0
+# leaves throttling to the latency-driven IOGovernor.
+EFS_MAX_OPS_PER_SECOND = float(os.environ.get("EFS_MAX_OPS_PER_SECOND", "0"))
+EFS_MIN_OPS_PER_SECOND = float(os.environ.get("EFS_MIN_OPS_PER_SECOND", "100"))
+EFS_LATENCY_THRESHOLD_MS = float(os.environ.get("EFS_LATENCY_THRESHOLD_MS", "50"))
+GOVERNOR_ADJUST_SECONDS = 0.5
+CHECKPOINT_PATH = os.environ.get("CHECKPOINT_PATH")
+REPORT_PATH = os.environ.get("REPORT_PATH")
+INVENTORY_MODE = os.environ.get("INVENTORY_MODE", "set")
+INVENTORY_SIZE_COLUMN = os.environ.get("INVENTORY_SIZE_COLUMN")
+INVENTORY_ETAG_COLUMN = os.environ.get("INVENTORY_ETAG_COLUMN")
+VERIFY_ETAG = os.environ.get("VERIFY_ETAG", "false").lower() == "true"
+INVENTORY_WORKERS = os.environ.get("INVENTORY_WORKERS", "8")
+INVENTORY_LOOKBACK_DAYS = os.environ.get("INVENTORY_LOOKBACK_DAYS", "7")
+INVENTORY_CACHE_DIR = os.environ.get("INVENTORY_CACHE_DIR", "/tmp")
+INVENTORY_READ_SIZE = 1024 * 1024
+INVENTORY_INDEX_FORMAT = 2
+REPORT_PART_SIZE = 8 * 1024 * 1024
+AGE_BUCKET_DAYS = [1, 7, 30, 90, 180, 365]
 
 if not all([
     EFS_MOUNT_PATH,
@@ -25,122 +77,1298 @@ if not all([
 
 RETENTION_DAYS = int(RETENTION_DAYS)
 TIMEOUT_BUFFER_SECONDS = int(TIMEOUT_BUFFER_SECONDS)
+WALKER_WORKERS = max(1, int(WALKER_WORKERS))
+INVENTORY_WORKERS = max(1, int(INVENTORY_WORKERS))
+INVENTORY_LOOKBACK_DAYS = int(INVENTORY_LOOKBACK_DAYS)
+
+if INVENTORY_MODE not in ("set", "merge"):
+    raise Exception(f"Unknown INVENTORY_MODE: {INVENTORY_MODE}")
+
+INVENTORY_SIZE_COLUMN = (
+    int(INVENTORY_SIZE_COLUMN) if INVENTORY_SIZE_COLUMN else None
+)
+INVENTORY_ETAG_COLUMN = (
+    int(INVENTORY_ETAG_COLUMN) if INVENTORY_ETAG_COLUMN else None
+)
+
+if not CHECKPOINT_PATH:
+    CHECKPOINT_PATH = os.path.join(
+        EFS_MOUNT_PATH, ".crm_core_log_cleanup_checkpoint.json"
+    )
 
 s3 = boto3.client("s3")
+inventory_indexes = {}
 
+# S3 Inventory delivers each run to <prefix>/<YYYY-MM-DDTHH-MMZ>/ as a
+# manifest.json listing the gzip CSV data files. The newest manifest is
+# found by listing one day's prefix at a time, starting today, rather than
+# paging through every data file under INVENTORY_PREFIX. A prefix holding
+# a single CSV and no manifest falls back to its newest object; one whose
+# manifests are all older than INVENTORY_LOOKBACK_DAYS uses the newest one.
 def get_latest_inventory_key():
+    prefix = INVENTORY_PREFIX.rstrip("/") + "/"
+    today = datetime.datetime.now(datetime.timezone.utc).date()
     paginator = s3.get_paginator("list_objects_v2")
+    for days in range(INVENTORY_LOOKBACK_DAYS + 1):
+        day = (today - datetime.timedelta(days=days)).isoformat()
+        manifests = [
+            obj["Key"]
+            for page in paginator.paginate(
+                Bucket=INVENTORY_BUCKET,
+                Prefix=prefix + day
+            )
+            for obj in page.get("Contents", [])
+            if obj["Key"].endswith("/manifest.json")
+        ]
+        if manifests:
+            return max(manifests)
+
     latest = None
+    latest_manifest = None
     for page in paginator.paginate(
         Bucket=INVENTORY_BUCKET,
         Prefix=INVENTORY_PREFIX
     ):
         for obj in page.get("Contents", []):
-            if not latest or obj["LastModified"] > latest["LastModified"]:
+            if obj["Key"].endswith("/manifest.json"):
+                if not latest_manifest or obj["LastModified"] > latest_manifest["LastModified"]:
+                    latest_manifest = obj
+            elif not latest or obj["LastModified"] > latest["LastModified"]:
                 latest = obj
 
+    if latest_manifest:
+        print(
+            f"No inventory manifest within {INVENTORY_LOOKBACK_DAYS} days, "
+            f"using {latest_manifest['Key']}"
+        )
+        return latest_manifest["Key"]
+
     if not latest:
-        raise Exception("No inventory file found in S3.")
+        raise Exception(
+            "No inventory manifest or CSV found under "
+            f"s3://{INVENTORY_BUCKET}/{INVENTORY_PREFIX}"
+        )
 
     return latest["Key"]
 
-def load_inventory_keys(inventory_key):
+# Returns the (data key, md5) pairs behind an inventory key and the
+# layout to read them with. Manifest CSV data files have no header row,
+# carry URL-encoded keys and describe their columns in fileSchema; Parquet
+# and ORC data files name their columns (key, size, e_tag). The manifest
+# itself is checked against manifest.checksum.
+def load_inventory_files(inventory_key):
+    if not inventory_key.endswith("manifest.json"):
+        layout = {
+            "format": "CSV",
+            "header": True,
+            "url_encoded": False,
+            "key": "Key",
+            "size": (
+                INVENTORY_SIZE_COLUMN
+                if INVENTORY_SIZE_COLUMN is not None else "Size"
+            ),
+            "etag": (
+                INVENTORY_ETAG_COLUMN
+                if INVENTORY_ETAG_COLUMN is not None else "ETag"
+            )
+        }
+        return [(inventory_key, None)], layout
+
+    body = s3.get_object(
+        Bucket=INVENTORY_BUCKET,
+        Key=inventory_key
+    )["Body"].read()
+    checksum = s3.get_object(
+        Bucket=INVENTORY_BUCKET,
+        Key=inventory_key[:-len("manifest.json")] + "manifest.checksum"
+    )["Body"].read().decode("utf-8").strip()
+    if hashlib.md5(body).hexdigest() != checksum:
+        raise Exception(f"Inventory manifest {inventory_key} failed its MD5 check")
+
+    manifest = json.loads(body)
+    file_format = manifest.get("fileFormat", "CSV")
+    if file_format == "CSV":
+        columns = [
+            column.strip() for column in manifest["fileSchema"].split(",")
+        ]
+        layout = {
+            "format": file_format,
+            "header": False,
+            "url_encoded": True,
+            "columns": len(columns),
+            "key": columns.index("Key"),
+            "size": columns.index("Size") if "Size" in columns else None,
+            "etag": columns.index("ETag") if "ETag" in columns else None
+        }
+    elif file_format in ("Parquet", "ORC"):
+        if pyarrow is None:
+            raise Exception(
+                f"pyarrow is required to read {file_format} inventories"
+            )
+        columns = set(re.findall(r"\w+", manifest["fileSchema"]))
+        layout = {
+            "format": file_format,
+            "key": "key",
+            "size": "size" if "size" in columns else None,
+            "etag": "e_tag" if "e_tag" in columns else None
+        }
+    else:
+        raise Exception(f"Unsupported inventory format: {file_format}")
+
+    files = [
+        (entry["key"], entry.get("MD5checksum"))
+        for entry in manifest["files"]
+    ]
+    return files, layout
+
+# Hashes the compressed bytes as gzip pulls them off the response body.
+class MD5Reader:
+    def __init__(self, body):
+        self.body = body
+        self.digest = hashlib.md5()
+
+    def read(self, size=-1):
+        data = self.body.read(size)
+        self.digest.update(data)
+        return data
+
+# Yields blocks of whole lines, decompressing a megabyte of the gzip stream
+# at a time. Concatenated gzip members are followed through.
+def read_gzip_blocks(body):
+    decompressor = zlib.decompressobj(31)
+    tail = b""
+    while True:
+        chunk = body.read(INVENTORY_READ_SIZE)
+        if not chunk:
+            break
+        while chunk:
+            block = tail + decompressor.decompress(chunk)
+            end = block.rfind(b"\n") + 1
+            tail = block[end:]
+            if end:
+                yield block[:end]
+            chunk = b""
+            if decompressor.eof:
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(31)
+    if tail:
+        yield tail
+
+def read_gzip_lines(body):
+    for block in read_gzip_blocks(body):
+        yield block.split(b"\n")
+
+# A single CSV inventory names its columns in the header row. Columns are
+# looked up by name (ignoring case and underscores), unless the layout
+# already holds an index from INVENTORY_SIZE_COLUMN/INVENTORY_ETAG_COLUMN.
+# A missing column resolves to None and is not read; a missing Key column
+# falls back to the second column, where S3 Inventory puts it.
+def header_column(header, column):
+    if column is None or isinstance(column, int):
+        return column
+    names = [name.strip().lower().replace("_", "") for name in header]
+    name = column.lower().replace("_", "")
+    return names.index(name) if name in names else None
+
+# Manifest CSV data files quote every field and URL-encode the key, so no
+# field holds a comma and lines are split directly on the decompressed
+# bytes. A single CSV with a header row still goes through the csv module.
+# Keys that are not .gz files are dropped before they are decoded or their
+# other columns parsed.
+def read_csv_rows(data_key, md5, layout):
+    response = s3.get_object(
+        Bucket=INVENTORY_BUCKET,
+        Key=data_key
+    )
+
+    body = MD5Reader(response["Body"])
+    key_column = layout["key"]
+    size_column = layout["size"]
+    etag_column = layout["etag"]
+
+    if layout["url_encoded"]:
+        for lines in read_gzip_lines(body):
+            for line in lines:
+                if not line:
+                    continue
+                row = line.split(b",")
+                key = row[key_column].strip(b'"')
+                if not key.endswith(b".gz"):
+                    continue
+                if b"%" in key or b"+" in key:
+                    key = unquote_to_bytes(key.replace(b"+", b" "))
+                key = key.decode("utf-8", "surrogateescape")
+
+                size = None
+                if size_column is not None:
+                    value = row[size_column].strip(b'"')
+                    size = int(value) if value else None
+                etag = None
+                if etag_column is not None:
+                    etag = row[etag_column].strip(b'"\r').decode() or None
+                yield key, size, etag
+    else:
+        with gzip.GzipFile(fileobj=body) as gz:
+            text = io.TextIOWrapper(
+                io.BufferedReader(gz, INVENTORY_READ_SIZE),
+                encoding="utf-8",
+                newline=""
+            )
+            reader = csv.reader(text)
+            header = next(reader, [])
+            key_column = header_column(header, key_column)
+            if key_column is None:
+                key_column = 1
+            size_column = header_column(header, size_column)
+            etag_column = header_column(header, etag_column)
+            for row in reader:
+                key = row[key_column]
+                if not key.endswith(".gz"):
+                    continue
+
+                size = None
+                if size_column is not None and row[size_column]:
+                    size = int(row[size_column])
+                etag = None
+                if etag_column is not None:
+                    etag = row[etag_column].strip('"') or None
+                yield key, size, etag
+
+    while body.read(INVENTORY_READ_SIZE):
+        pass
+    if md5 and body.digest.hexdigest() != md5:
+        raise Exception(f"Inventory data file {data_key} failed its MD5 check")
+
+# Parquet and ORC need random access to their footer, so the data file is
+# read into memory. Only the needed columns are decoded, and the .gz filter
+# runs inside pyarrow on each record batch.
+def read_columnar_rows(data_key, md5, layout):
+    data = s3.get_object(
+        Bucket=INVENTORY_BUCKET,
+        Key=data_key
+    )["Body"].read()
+    if md5 and hashlib.md5(data).hexdigest() != md5:
+        raise Exception(f"Inventory data file {data_key} failed its MD5 check")
+
+    columns = [
+        column
+        for column in (layout["key"], layout["size"], layout["etag"])
+        if column
+    ]
+    source = pyarrow.BufferReader(data)
+    if layout["format"] == "Parquet":
+        batches = pyarrow_parquet.ParquetFile(source).iter_batches(
+            batch_size=65536,
+            columns=columns
+        )
+    else:
+        orc_file = pyarrow_orc.ORCFile(source)
+        batches = (
+            orc_file.read_stripe(stripe, columns=columns)
+            for stripe in range(orc_file.nstripes)
+        )
+
+    for batch in batches:
+        batch = batch.filter(
+            pyarrow_compute.ends_with(batch.column(layout["key"]), ".gz")
+        )
+        keys = batch.column(layout["key"]).to_pylist()
+        sizes = etags = [None] * len(keys)
+        if layout["size"]:
+            sizes = batch.column(layout["size"]).to_pylist()
+        if layout["etag"]:
+            etags = [
+                etag.strip('"') if etag else None
+                for etag in batch.column(layout["etag"]).to_pylist()
+            ]
+        yield from zip(keys, sizes, etags)
+
+# Streams (key, size, etag) rows for .gz keys from one data file, skipping
+# keys up to and including start_after and, when top_level is given, keys
+# outside those top-level directories ("." for files at the root). S3
+# writes each data file sorted by key; the merge-join relies on that, so
+# with check_order a file out of key order is an error. The set index
+# sorts the hashes itself and accepts any order.
+def read_inventory_file(
+    data_key, md5, layout, start_after=None, top_level=None, check_order=False
+):
+    if layout["format"] == "CSV":
+        rows = read_csv_rows(data_key, md5, layout)
+    else:
+        rows = read_columnar_rows(data_key, md5, layout)
+
+    previous = None
+    for row in rows:
+        key = row[0]
+        if check_order and previous is not None and key < previous:
+            raise Exception(
+                f"Inventory {data_key} is not sorted by key "
+                f"({key} after {previous})"
+            )
+        previous = key
+        if start_after is not None and key <= start_after:
+            continue
+        if top_level is not None:
+            name, separator, _ = key.partition("/")
+            if (name if separator else ".") not in top_level:
+                continue
+        yield row
+
+# Yields lists of the raw .gz keys of one data file for the index build:
+# keys stay bytes (URL-decoded where needed) and are never turned into
+# rows, so every step below runs over a whole batch at once.
+def read_key_batches(data_key, md5, layout):
+    if layout["format"] != "CSV":
+        data = s3.get_object(
+            Bucket=INVENTORY_BUCKET,
+            Key=data_key
+        )["Body"].read()
+        if md5 and hashlib.md5(data).hexdigest() != md5:
+            raise Exception(f"Inventory data file {data_key} failed its MD5 check")
+
+        source = pyarrow.BufferReader(data)
+        if layout["format"] == "Parquet":
+            batches = pyarrow_parquet.ParquetFile(source).iter_batches(
+                batch_size=65536,
+                columns=[layout["key"]]
+            )
+        else:
+            orc_file = pyarrow_orc.ORCFile(source)
+            batches = (
+                orc_file.read_stripe(stripe, columns=[layout["key"]])
+                for stripe in range(orc_file.nstripes)
+            )
+        for batch in batches:
+            keys = batch.column(layout["key"])
+            keys = keys.filter(pyarrow_compute.ends_with(keys, ".gz"))
+            yield keys.cast(pyarrow.binary()).to_pylist()
+        return
+
     response = s3.get_object(
+        Bucket=INVENTORY_BUCKET,
+        Key=data_key
+    )
+    body = MD5Reader(response["Body"])
+    key_column = layout["key"]
+
+    if layout["url_encoded"]:
+        # Every field is quoted and none holds a quote or a newline, so
+        # splitting a whole block on "," leaves columns - 1 pieces per row
+        # with the key (when it is neither the first nor the last column)
+        # unquoted at a fixed stride. A block whose pieces do not add up (a
+        # blank line, an unquoted field) is split line by line instead.
+        columns = layout["columns"]
+        split_row = methodcaller("split", b",", key_column + 1)
+        for block in read_gzip_blocks(body):
+            rows = block.count(b"\n") + (not block.endswith(b"\n"))
+            fields = block.split(b'","')
+            if 0 < key_column < columns - 1 and (
+                len(fields) == rows * (columns - 1) + 1
+            ):
+                keys = [
+                    key for key in fields[key_column::columns - 1]
+                    if key.endswith(b".gz")
+                ]
+            else:
+                keys = [
+                    row[key_column].strip(b'"')
+                    for row in map(split_row, block.split(b"\n"))
+                    if len(row) > key_column
+                    and row[key_column].endswith((b'.gz"', b".gz"))
+                ]
+            encoded = b"".join(keys)
+            if b"%" in encoded or b"+" in encoded:
+                keys = [
+                    unquote_to_bytes(key.replace(b"+", b" "))
+                    if b"%" in key or b"+" in key else key
+                    for key in keys
+                ]
+            yield keys
+    else:
+        with gzip.GzipFile(fileobj=body) as gz:
+            text = io.TextIOWrapper(
+                io.BufferedReader(gz, INVENTORY_READ_SIZE),
+                encoding="utf-8",
+                newline=""
+            )
+            reader = csv.reader(text)
+            key_column = header_column(next(reader, []), key_column)
+            if key_column is None:
+                key_column = 1
+            while True:
+                rows = list(islice(reader, 65536))
+                if not rows:
+                    break
+                yield [
+                    row[key_column].encode("utf-8", "surrogateescape")
+                    for row in rows
+                    if row[key_column].endswith(".gz")
+                ]
+
+    while body.read(INVENTORY_READ_SIZE):
+        pass
+    if md5 and body.digest.hexdigest() != md5:
+        raise Exception(f"Inventory data file {data_key} failed its MD5 check")
+
+# Key hashes are 8-byte BLAKE2b digests, read little-endian (the byte order
+# of Lambda's x86_64 and arm64), with the top three bits forced to 001. That
+# makes every hash also the bit pattern of a positive, normal double, and
+# those sort in the same order as the integers, so the index build sorts
+# them as floats, which is about twice as fast as sorting Python ints.
+# Copying a ready BLAKE2b state is cheaper than building one per key.
+KEY_HASH_STATE = hashlib.blake2b(digest_size=8)
+KEY_HASH_TOP_BYTE = bytes(0x20 | (value & 0x1F) for value in range(256))
+
+def blake2b_64(data):
+    state = KEY_HASH_STATE.copy()
+    state.update(data)
+    return state.digest()
+
+def key_hash(key):
+    value = int.from_bytes(
+        blake2b_64(key.encode("utf-8", "surrogateescape")),
+        "little"
+    )
+    return value & 0x1FFFFFFFFFFFFFFF | 0x2000000000000000
+
+# The hashes of a batch of raw keys as packed 8-byte values: the digests
+# are joined and the top byte of each is fixed up in a single translate
+# over a strided slice.
+def key_digests(keys):
+    digests = bytearray(b"".join(map(blake2b_64, keys)))
+    digests[7::8] = digests[7::8].translate(KEY_HASH_TOP_BYTE)
+    return digests
+
+# Sorted 61-bit key hashes of the inventory keys, memory-mapped from the
+# index file, so membership is a binary search over the mapping and the
+# keys never exist as Python strings. At ten million keys the chance of a
+# file outside the inventory matching one of them is about 1 in 2 * 10^11.
+class InventoryIndex:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size % 8:
+                raise ValueError(f"Truncated inventory index {path}")
+            self.map = None
+            if size:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.hashes = memoryview(self.map or b"").cast("Q")
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, key):
+        value = key_hash(key)
+        position = bisect_left(self.hashes, value)
+        return position < len(self.hashes) and self.hashes[position] == value
+
+# Index files are named after the inventory source, the inventory key +
+# ETag, the top-level filter and the index format, so a new inventory (or
+# a new key hash) never reuses an old index. Indexes for the same source
+# left over from earlier days are removed.
+def inventory_index_path(inventory_key, etag, top_level=None):
+    source = hashlib.sha1(
+        f"{INVENTORY_BUCKET}/{INVENTORY_PREFIX}".encode("utf-8")
+    ).hexdigest()[:12]
+    scope = ",".join(sorted(top_level)) if top_level is not None else "*"
+    version = hashlib.sha1(
+        f"{inventory_key}:{etag}:{scope}:{INVENTORY_INDEX_FORMAT}".encode("utf-8")
+    ).hexdigest()[:16]
+    return os.path.join(
+        INVENTORY_CACHE_DIR, f"inventory-{source}-{version}.idx"
+    )
+
+def remove_stale_indexes(path):
+    name = os.path.basename(path)
+    source = name.rsplit("-", 1)[0] + "-"
+    cutoff = time.time() - 86400
+    for entry in os.scandir(INVENTORY_CACHE_DIR):
+        if not entry.name.startswith(source) or entry.name == name:
+            continue
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            continue
+
+# Downloads and parses the data files through a bounded pool, then writes
+# the sorted key hashes to path. Written to a temporary file first so that
+# concurrent shard workers never see a partial index.
+def build_inventory_index(inventory_key, path, top_level=None):
+    files, layout = load_inventory_files(inventory_key)
+    if top_level is not None:
+        top_level = {
+            name.encode("utf-8", "surrogateescape") for name in top_level
+        }
+
+    def read_hashes(data_file):
+        data_key, md5 = data_file
+        hashes = array("d")
+        for keys in read_key_batches(data_key, md5, layout):
+            if top_level is not None:
+                keys = [
+                    key for key in keys
+                    if (key.partition(b"/")[0] if b"/" in key else b".")
+                    in top_level
+                ]
+            hashes.frombytes(key_digests(keys))
+        return hashes
+
+    hashes = array("d")
+    with ThreadPoolExecutor(max_workers=INVENTORY_WORKERS) as executor:
+        for file_hashes in executor.map(read_hashes, files):
+            hashes.extend(file_hashes)
+    hashes = array("d", sorted(hashes))
+
+    os.makedirs(INVENTORY_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        hashes.tofile(f)
+    os.replace(tmp_path, path)
+    remove_stale_indexes(path)
+
+    print(f"Indexed {len(hashes)} inventory keys from {len(files)} data files")
+
+# A single CSV inventory can be overwritten in place under the same key, so
+# the key alone does not identify an inventory run; its ETag does.
+def get_inventory_etag(inventory_key):
+    return s3.head_object(
         Bucket=INVENTORY_BUCKET,
         Key=inventory_key
+    )["ETag"].strip('"')
+
+# The inventory only changes once a day, so its index is kept in module
+# scope for warm starts and on disk (INVENTORY_CACHE_DIR: /tmp, or a path
+# on EFS to share it between cold starts and shard workers).
+def load_inventory_keys(inventory_key, top_level=None, etag=None):
+    etag = etag or get_inventory_etag(inventory_key)
+    path = inventory_index_path(inventory_key, etag, top_level)
+    if path in inventory_indexes:
+        print(f"Reusing in-memory inventory index for {inventory_key}")
+        return inventory_indexes[path]
+
+    try:
+        index = InventoryIndex(path)
+        print(f"Reusing inventory index {path}")
+    except (OSError, ValueError):
+        build_inventory_index(inventory_key, path, top_level)
+        index = InventoryIndex(path)
+
+    inventory_indexes.clear()
+    inventory_indexes[path] = index
+    return index
+
+# Streams (key, size, etag) rows across all data files in key order.
+def iter_inventory(inventory_key, start_after=None, top_level=None):
+    files, layout = load_inventory_files(inventory_key)
+    return heapq.merge(
+        *(
+            read_inventory_file(
+                data_key, md5, layout, start_after, top_level, check_order=True
+            )
+            for data_key, md5 in files
+        ),
+        key=lambda row: row[0]
     )
 
-    keys = set()
-    with gzip.GzipFile(fileobj=response["Body"]) as gz:
-        reader = csv.reader(
-            line.decode("utf-8") for line in gz
+def file_md5(path):
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Multipart ETags ("<md5>-<parts>") depend on the part size used for the
+# upload, so only single-part ETags are compared against the EFS content.
+def verify_inventory_copy(full_path, st, row):
+    _, size, etag = row
+    if size is not None and size != st.st_size:
+        return "size mismatch"
+    if VERIFY_ETAG and etag and "-" not in etag:
+        if file_md5(full_path) != etag:
+            return "checksum mismatch"
+    return None
+
+# The checkpoint lives either on EFS (a plain path) or in S3
+# (s3://bucket/key) and records the walk frontier relative to
+# EFS_MOUNT_PATH, plus the inventory key and ETag it was built against.
+def load_checkpoint():
+    try:
+        if CHECKPOINT_PATH.startswith("s3://"):
+            bucket, key = CHECKPOINT_PATH[5:].split("/", 1)
+            response = s3.get_object(Bucket=bucket, Key=key)
+            return json.loads(response["Body"].read())
+        with open(CHECKPOINT_PATH) as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"No usable checkpoint at {CHECKPOINT_PATH}: {e}")
+        return None
+
+def save_checkpoint(state):
+    body = json.dumps(state)
+    if CHECKPOINT_PATH.startswith("s3://"):
+        bucket, key = CHECKPOINT_PATH[5:].split("/", 1)
+        s3.put_object(Bucket=bucket, Key=key, Body=body.encode("utf-8"))
+        return
+    tmp_path = CHECKPOINT_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(body)
+    os.replace(tmp_path, CHECKPOINT_PATH)
+
+def to_relative(path):
+    return os.path.relpath(path, EFS_MOUNT_PATH)
+
+def to_absolute(relative_path):
+    return os.path.normpath(os.path.join(EFS_MOUNT_PATH, relative_path))
+
+# Shared by every walker thread and kept across warm invocations. Each
+# metadata operation (directory listing, stat, unlink, rmdir) takes a slot
+# at the current rate limit. The EWMA of per-operation latency drives an
+# AIMD loop: the rate halves while latency is above the threshold and
+# climbs back by a tenth of the ceiling while it is below. The ceiling is
+# EFS_MAX_OPS_PER_SECOND when it is set (a fixed cap, off by default);
+# otherwise there is no limit until latency first crosses the threshold,
+# the measured rate at that point becomes the ceiling, and the limit is
+# lifted again once the rate climbs back to it.
+class IOGovernor:
+    def __init__(self, max_ops_per_second, min_ops_per_second, latency_threshold_ms):
+        self.max_rate = max_ops_per_second or None
+        self.min_rate = min(min_ops_per_second, self.max_rate or min_ops_per_second)
+        self.rate = self.max_rate
+        self.ceiling = self.max_rate
+        self.threshold = latency_threshold_ms / 1000
+        self.latency = None
+        self.throttled_seconds = 0.0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+        self.next_adjustment = self.next_slot + GOVERNOR_ADJUST_SECONDS
+        self.window_start = self.next_slot
+        self.window_ops = 0
+
+    def acquire(self):
+        with self.lock:
+            self.window_ops += 1
+            if self.rate is None:
+                return
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + 1 / self.rate
+            delay = slot - now
+            self.throttled_seconds += delay
+        if delay > 0:
+            time.sleep(delay)
+
+    def record(self, elapsed, weight=1):
+        latency = elapsed / weight
+        with self.lock:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+
+            now = time.monotonic()
+            if now < self.next_adjustment:
+                return
+            self.next_adjustment = now + GOVERNOR_ADJUST_SECONDS
+            measured_rate = self.window_ops / (now - self.window_start)
+            self.window_start = now
+            self.window_ops = 0
+            if self.latency > self.threshold:
+                if self.rate is None:
+                    self.ceiling = max(self.min_rate, measured_rate)
+                    self.rate = self.ceiling
+                    self.next_slot = now
+                self.rate = max(self.min_rate, self.rate / 2)
+            elif self.rate is not None:
+                self.rate = min(self.ceiling, self.rate + self.ceiling / 10)
+                if self.max_rate is None and self.rate >= self.ceiling:
+                    self.rate = None
+
+    def run(self, operation, *args):
+        self.acquire()
+        start = time.perf_counter()
+        try:
+            return operation(*args)
+        finally:
+            self.record(time.perf_counter() - start)
+
+    def stats(self):
+        return {
+            "ops_per_second_limit": None if self.rate is None else round(self.rate, 1),
+            "latency_ms": round((self.latency or 0) * 1000, 2),
+            "throttled_seconds": round(self.throttled_seconds, 2)
+        }
+
+io_governor = IOGovernor(
+    EFS_MAX_OPS_PER_SECOND,
+    EFS_MIN_OPS_PER_SECOND,
+    EFS_LATENCY_THRESHOLD_MS
+)
+
+def list_directory(path):
+    with os.scandir(path) as entries:
+        return list(entries)
+
+# One scandir pass per directory. DirEntry.stat() is cached on the entry, so
+# the walker never issues a second os.stat round trip for the same file. A
+# listing's latency is spread over one operation per 512 entries returned.
+def scan_directory(path, descend=True):
+    subdirs = []
+    files = []
+    try:
+        io_governor.acquire()
+        start = time.perf_counter()
+        entries = list_directory(path)
+        io_governor.record(
+            time.perf_counter() - start, 1 + len(entries) // 512
+        )
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if descend:
+                    subdirs.append(entry.path)
+            elif entry.name.endswith(".gz"):
+                try:
+                    files.append((entry.path, io_governor.run(entry.stat)))
+                except FileNotFoundError:
+                    continue
+    except OSError as e:
+        print(f"Error listing {path}: {e}")
+    return path, subdirs, files
+
+def remove_file(path):
+    try:
+        io_governor.run(os.remove, path)
+        return path, None
+    except Exception as e:
+        return path, e
+
+def remove_directory(path):
+    try:
+        io_governor.run(os.rmdir, path)
+        return path, True
+    except OSError:
+        return path, False
+
+# The mount root is always kept. KEEP_DIRS lists further directories
+# (relative to EFS_MOUNT_PATH) to keep; without it every top-level
+# directory is kept.
+def is_kept_directory(path):
+    relative_path = os.path.relpath(path, EFS_MOUNT_PATH)
+    if relative_path == "." or relative_path.startswith(".."):
+        return True
+    if KEEP_DIRS:
+        return relative_path in KEEP_DIRS
+    return "/" not in relative_path
+
+# Removes directories emptied during this run deepest first, in batches,
+# then moves up to parents that became empty in turn. os.rmdir refuses a
+# directory that is not empty, so a file written concurrently keeps its
+# directory alive.
+def remove_empty_directories(executor, directories, should_stop):
+    removed = 0
+    pending = {path for path in directories if not is_kept_directory(path)}
+    while pending:
+        depth = max(path.count(os.sep) for path in pending)
+        level = sorted(path for path in pending if path.count(os.sep) == depth)
+        pending.difference_update(level)
+        for start in range(0, len(level), EMPTY_DIR_BATCH_SIZE):
+            if should_stop():
+                return removed
+            batch = level[start:start + EMPTY_DIR_BATCH_SIZE]
+            for path, was_removed in executor.map(remove_directory, batch):
+                if not was_removed:
+                    continue
+                removed += 1
+                parent = os.path.dirname(path)
+                if not is_kept_directory(parent):
+                    pending.add(parent)
+    return removed
+
+# Lists directories through a bounded thread pool and yields
+# (directory, [(path, stat), ...]) batches back to the caller's thread.
+# Frontier entries are (path, descend) pairs; descend=False re-lists only
+# the files of a directory whose subdirectories are already queued.
+# Directories that were queued or in flight when the walk stopped are put
+# back on the frontier.
+class ParallelWalker:
+    def __init__(self, executor, frontier, should_stop):
+        self.executor = executor
+        self.frontier = deque(frontier)
+        self.should_stop = should_stop
+        self.stopped = False
+
+    def revisit(self, path):
+        self.frontier.appendleft((path, False))
+
+    def walk(self):
+        listing = {}
+        try:
+            while self.frontier or listing:
+                if self.should_stop():
+                    self.stopped = True
+                    return
+                while self.frontier and len(listing) < WALKER_WORKERS:
+                    item = self.frontier.popleft()
+                    listing[self.executor.submit(scan_directory, *item)] = item
+                done, _ = wait(listing, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del listing[future]
+                    path, subdirs, files = future.result()
+                    self.frontier.extend((subdir, True) for subdir in subdirs)
+                    yield path, files
+        finally:
+            for future, item in listing.items():
+                future.cancel()
+                self.frontier.appendleft(item)
+
+def stat_entry(entry):
+    try:
+        return io_governor.run(entry.stat)
+    except FileNotFoundError:
+        return None
+
+# Walks EFS one directory at a time in S3 key order, so the walk can be
+# merge-joined against the sorted inventory in constant memory. Entries are
+# sorted by name with "/" appended to directories, which matches how their
+# descendants' keys sort against sibling files. The .gz files between two
+# subdirectories are stat'ed together through the pool.
+class SortedWalker:
+    def __init__(self, executor, start_after=None, prune=None, top_level=None):
+        self.executor = executor
+        self.start_after = start_after
+        self.prune = prune
+        self.top_level = top_level
+        self.pruned = 0
+
+    def walk(self):
+        return self.walk_directory(EFS_MOUNT_PATH, "", self.start_after)
+
+    def sorted_entries(self, path, relative_dir):
+        io_governor.acquire()
+        start = time.perf_counter()
+        entries = list_directory(path)
+        io_governor.record(
+            time.perf_counter() - start, 1 + len(entries) // 512
         )
-        next(reader)
-        for row in reader:
-            keys.add(row[1])
 
-    return keys
+        at_top = self.top_level is not None and not relative_dir
+        keyed = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if not at_top or entry.name in self.top_level:
+                    keyed.append((entry.name + "/", entry))
+            elif entry.name.endswith(".gz"):
+                if not at_top or "." in self.top_level:
+                    keyed.append((entry.name, entry))
+        keyed.sort(key=lambda item: item[0])
+        return keyed
+
+    def walk_directory(self, path, relative_dir, start_after):
+        try:
+            keyed = self.sorted_entries(path, relative_dir)
+        except OSError as e:
+            print(f"Error listing {path}: {e}")
+            return
+
+        run = []
+        for key, entry in keyed + [(None, None)]:
+            if entry is not None and not key.endswith("/"):
+                relative_path = relative_dir + key
+                if start_after is None or relative_path > start_after:
+                    run.append((relative_path, entry))
+                continue
+
+            if run:
+                stats = self.executor.map(stat_entry, [e for _, e in run])
+                for (relative_path, file_entry), st in zip(run, stats):
+                    if st is not None:
+                        yield relative_path, file_entry.path, st
+                run = []
+            if entry is None:
+                break
+
+            dir_key = relative_dir + key
+            child_start_after = None
+            if start_after is not None and start_after >= dir_key:
+                if not start_after.startswith(dir_key):
+                    continue
+                child_start_after = start_after
+            if self.prune and self.prune(entry.path):
+                self.pruned += 1
+                continue
+            yield from self.walk_directory(
+                entry.path, dir_key, child_start_after
+            )
+
+# Buffers the compressed report and uploads it as S3 multipart parts, so
+# only one part is ever held in memory.
+class S3MultipartWriter:
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+        self.upload_id = s3.create_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            ContentType="application/gzip"
+        )["UploadId"]
+        self.parts = []
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= REPORT_PART_SIZE:
+            self.upload_part()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def upload_part(self):
+        part_number = len(self.parts) + 1
+        response = s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=bytes(self.buffer)
+        )
+        self.parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        self.buffer.clear()
+
+    def close(self):
+        if self.buffer or not self.parts:
+            self.upload_part()
+        s3.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts}
+        )
+
+    def abort(self):
+        s3.abort_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id
+        )
+
+# Streams one NDJSON record per file to REPORT_PATH (s3://bucket/prefix or
+# an EFS directory) and keeps only aggregate counters in memory.
+class CleanupReport:
+    def __init__(self, name):
+        self.location = None
+        self.target = None
+        self.stream = None
+        self.deleted_count = 0
+        self.skipped_count = 0
+        self.bytes_reclaimed = 0
+        self.prefixes = {}
+        self.skip_reasons = {}
+        self.age_histogram = {}
+
+        if not REPORT_PATH:
+            return
+
+        self.location = f"{REPORT_PATH.rstrip('/')}/{name}.ndjson.gz"
+        if self.location.startswith("s3://"):
+            bucket, key = self.location[5:].split("/", 1)
+            self.target = S3MultipartWriter(bucket, key)
+        else:
+            os.makedirs(os.path.dirname(self.location), exist_ok=True)
+            self.target = open(self.location + ".tmp", "wb")
+        self.stream = gzip.GzipFile(fileobj=self.target, mode="wb")
+
+    def add(self, path, action, reason, size, age):
+        relative_path = os.path.relpath(path, EFS_MOUNT_PATH)
+        prefix = relative_path.split("/", 1)[0] if "/" in relative_path else "."
+        counters = self.prefixes.setdefault(
+            prefix, {"deleted": 0, "skipped": 0, "bytes_reclaimed": 0}
+        )
+
+        if action == "deleted":
+            self.deleted_count += 1
+            self.bytes_reclaimed += size
+            counters["deleted"] += 1
+            counters["bytes_reclaimed"] += size
+        else:
+            self.skipped_count += 1
+            counters["skipped"] += 1
+            label = reason.split(":", 1)[0]
+            self.skip_reasons[label] = self.skip_reasons.get(label, 0) + 1
+
+        age_days = age / 86400
+        bucket = f">={AGE_BUCKET_DAYS[-1]}d"
+        lower = 0
+        for upper in AGE_BUCKET_DAYS:
+            if age_days < upper:
+                bucket = f"{lower}-{upper}d"
+                break
+            lower = upper
+        self.age_histogram[bucket] = self.age_histogram.get(bucket, 0) + 1
+
+        if self.stream:
+            record = {
+                "path": relative_path,
+                "action": action,
+                "reason": reason,
+                "size": size,
+                "age_days": round(age_days, 2)
+            }
+            self.stream.write((json.dumps(record) + "\n").encode("utf-8"))
+
+    def close(self):
+        if not self.stream:
+            return
+        self.stream.close()
+        self.target.close()
+        if not self.location.startswith("s3://"):
+            os.replace(self.location + ".tmp", self.location)
+
+    # Discards a report the handler could not finish, so a failed run does
+    # not leave an open multipart upload (billed until a lifecycle rule
+    # removes it) or a .tmp file behind.
+    def abort(self):
+        if not self.stream:
+            return
+        stream, self.stream = self.stream, None
+        try:
+            if self.location.startswith("s3://"):
+                self.target.abort()
+            else:
+                stream.close()
+                self.target.close()
+                os.remove(self.location + ".tmp")
+        except Exception as e:
+            print(f"Error discarding report {self.location}: {e}")
+
+    def summary(self):
+        return {
+            "deleted_count": self.deleted_count,
+            "skipped_count": self.skipped_count,
+            "bytes_reclaimed": self.bytes_reclaimed,
+            "by_prefix": self.prefixes,
+            "skip_reasons": self.skip_reasons,
+            "age_histogram": self.age_histogram,
+            "report_location": self.location
+        }
 
 def lambda_handler(event, context):
     now = time.time()
     retention_seconds = RETENTION_DAYS * 86400
 
     inventory_key = get_latest_inventory_key()
-    s3_keys = load_inventory_keys(inventory_key)
-
-    deleted_count = 0
-    skipped_count = 0
-    deleted_files = []
-    skipped_files = []
+    inventory_etag = get_inventory_etag(inventory_key)
+    frontier = [(EFS_MOUNT_PATH, True)]
+    start_after = None
 
-    for root, _, files in os.walk(EFS_MOUNT_PATH):
-        for file in files:
-            remaining_time_seconds = (
-                context.get_remaining_time_in_millis() / 1000
+    checkpoint = load_checkpoint()
+    if (
+        checkpoint
+        and checkpoint.get("inventory_key") == inventory_key
+        and checkpoint.get("inventory_etag") == inventory_etag
+        and checkpoint.get("mode", "set") == INVENTORY_MODE
+    ):
+        if checkpoint.get("completed", not checkpoint.get("frontier")):
+            print(f"Cleanup already completed for inventory {inventory_key}")
+            return {
+                "statusCode": 200,
+                "message": "Already completed for latest inventory",
+                "deleted_count": 0,
+                "skipped_count": 0
+            }
+        if INVENTORY_MODE == "merge":
+            start_after = checkpoint["after"]
+            print(
+                f"Resuming merge-join after {start_after} "
+                f"for inventory {inventory_key}"
             )
+        else:
+            frontier = [
+                (to_absolute(path), descend)
+                for path, descend in checkpoint["frontier"]
+            ]
+            print(
+                f"Resuming from checkpoint with {len(frontier)} "
+                f"directories left for inventory {inventory_key}"
+            )
+    elif checkpoint:
+        print(
+            f"Newer inventory {inventory_key} or mode {INVENTORY_MODE} "
+            f"found, restarting walk from {EFS_MOUNT_PATH}"
+        )
 
-            if remaining_time_seconds <= TIMEOUT_BUFFER_SECONDS:
-                print(
-                    f"Stopping early due to timeout buffer. "
-                    f"Re\nDeleted files ({deleted_count}):")
-                for file_path in deleted_files:
-                    print(f"  {file_path}")
-                print(f"\nSkipped files ({skipped_count}):")
-                for file_path in skipped_files:
-                    print(f"  {file_path}")
-                print(f"\nmaining time: {remaining_time_seconds:.2f}s"
+    request_id = getattr(context, "aws_request_id", None) or str(int(now))
+    report = CleanupReport(
+        f"{time.strftime('%Y/%m/%d', time.gmtime(now))}/"
+        f"crm-core-log-cleanup-{request_id}"
+    )
+
+    def should_stop():
+        remaining_time_seconds = (
+            context.get_remaining_time_in_millis() / 1000
+        )
+        return remaining_time_seconds <= TIMEOUT_BUFFER_SECONDS
+
+    def collect(removals):
+        for future in removals:
+            full_path, error = future.result()
+            size, age = pending.pop(future)
+            if error is None:
+                report.add(full_path, "deleted", None, size, age)
+                if REMOVE_EMPTY_DIRS:
+                    emptied.add(os.path.dirname(full_path))
+            else:
+                report.add(full_path, "skipped", f"error: {error}", size, age)
+                print(f"Error deleting {full_path}: {error}")
+
+    def queue_removal(full_path, size, age):
+        nonlocal removals
+        future = executor.submit(remove_file, full_path)
+        pending[future] = (size, age)
+        removals.add(future)
+        if len(removals) >= WALKER_WORKERS * 4:
+            done, removals = wait(removals, return_when=FIRST_COMPLETED)
+            collect(done)
+
+    def should_stop_pruning():
+        remaining_time_seconds = context.get_remaining_time_in_millis() / 1000
+        return remaining_time_seconds <= TIMEOUT_BUFFER_SECONDS / 2
+
+    # Default mode: a key set built from the whole inventory, probed by the
+    # parallel walker in whatever order directories come back.
+    def run_inventory_set():
+        s3_keys = load_inventory_keys(inventory_key, etag=inventory_etag)
+        walker = ParallelWalker(executor, frontier, should_stop)
+        batches = walker.walk()
+        stopped = False
+
+        for directory, files in batches:
+            for full_path, st in files:
+                if should_stop():
+                    stopped = True
+                    walker.revisit(directory)
+                    break
+
+                age = now - st.st_mtime
+
+                if age < retention_seconds:
+                    report.add(
+                        full_path, "skipped", "too recent", st.st_size, age
+                    )
+                    continue
+
+                s3_key = full_path.replace(
+                    EFS_MOUNT_PATH + "/", ""
                 )
-                print(f"Total deleted files: {deleted_count}")
-                print(f"Total skipped files: {skipped_count}")
-                return {
-                    "statusCode": 200,
-                    "message": "Stopped early due to timeout buffer",
-                    "deleted_count": deleted_count,
-                    "skipped_count": skipped_count
-                }
-
-            if not file.endswith(".gz"):
-                continue
 
-            full_path = os.path.join(root, file)
-            age = now - os.stat(full_path).st_mtime
+                if s3_key in s3_keys:
+                    queue_removal(full_path, st.st_size, age)
+                else:
+                    report.add(
+                        full_path, "skipped", "not in inventory",
+                        st.st_size, age
+                    )
+
+            if stopped:
+                break
+
+        batches.close()
+        return {
+            "frontier": [
+                [to_relative(path), descend]
+                for path, descend in walker.frontier
+            ],
+            "completed": not (stopped or walker.stopped)
+        }
+
+    # INVENTORY_MODE=merge: the sorted walk and the sorted inventory stream
+    # advance together, so memory does not grow with either side, and the
+    # matched inventory row is checked for size (and optionally ETag).
+    def run_merge_join():
+        walker = SortedWalker(executor, start_after)
+        rows = iter_inventory(inventory_key, start_after)
+        row = next(rows, None)
+        last_key = start_after
+
+        for relative_path, full_path, st in walker.walk():
+            if should_stop():
+                return {"after": last_key, "completed": False}
+
+            while row and row[0] < relative_path:
+                row = next(rows, None)
+            last_key = relative_path
+
+            age = now - st.st_mtime
 
             if age < retention_seconds:
-                skipped_count += 1
-                skipped_files.append(f"{full_path} (too recent)")
-                print(f"Skipped (too recent): {full_path}")
+                report.add(full_path, "skipped", "too recent", st.st_size, age)
                 continue
 
-            s3_key = full_path.replace(
-                EFS_MOUNT_PATH + "/", ""
-            )
+            if not row or row[0] != relative_path:
+                report.add(
+                    full_path, "skipped", "not in inventory", st.st_size, age
+                )
+                continue
 
-            if s3_key in s3_keys:
-                try:
-                    os.remove(full_path)
-                    deleted_count += 1
-                    deleted_files.append(full_path)
-                    print(f"Deleted: {full_path}")
-                except Exception as e:
-                    skipped_count += 1
-                    skipped_files.append(f"{full_path} (error: {e})")
-                    print(f"Error deleting {full_path}: {e}")
+            reason = verify_inventory_copy(full_path, st, row)
+            if reason:
+                report.add(full_path, "skipped", reason, st.st_size, age)
+                continue
+
+            queue_removal(full_path, st.st_size, age)
+
+        return {"after": None, "completed": True}
+
+    emptied = set()
+    empty_dirs_removed = 0
+    removals = set()
+    pending = {}
+    try:
+        with ThreadPoolExecutor(max_workers=WALKER_WORKERS) as executor:
+            if INVENTORY_MODE == "merge":
+                state = run_merge_join()
             else:
-                skipped_count += 1
-                skipped_files.append(f"{full_path} (not in inventory)")
-                print(f"Skipped (not in inventory): {full_path}")
-
-    print(f"\nDeleted files ({deleted_count}):")
-    for file_path in deleted_files:
-        print(f"  {file_path}")
-    print(f"\nSkipped files ({skipped_count}):")
-    for file_path in skipped_files:
-        print(f"  {file_path}")
-    print(f"\nTotal deleted files: {deleted_count}")
-    print(f"Total skipped files: {skipped_count}")
+                state = run_inventory_set()
+            collect(wait(removals).done)
+            stopped = not state["completed"]
+
+            if emptied:
+                empty_dirs_removed = remove_empty_directories(
+                    executor, emptied, should_stop_pruning
+                )
+                print(f"Removed empty directories: {empty_dirs_removed}")
+
+        report.close()
+    except Exception:
+        report.abort()
+        raise
+    summary = report.summary()
+    summary["empty_dirs_removed"] = empty_dirs_removed
+    summary["io_governor"] = io_governor.stats()
+    print(f"Cleanup summary: {json.dumps(summary)}")
+
+    save_checkpoint({
+        "inventory_key": inventory_key,
+        "inventory_etag": inventory_etag,
+        "mode": INVENTORY_MODE,
+        **state
+    })
+
+    if stopped:
+        remaining_time_seconds = (
+            context.get_remaining_time_in_millis() / 1000
+        )
+        print(
+            f"Stopping early due to timeout buffer. "
+            f"Remaining time: {remaining_time_seconds:.2f}s"
+        )
+        return {
+            "statusCode": 200,
+            "message": "Stopped early due to timeout buffer",
+            **summary
+        }
 
     return {
         "statusCode": 200,
-        "deleted_count": deleted_count,
-        "skipped_count": skipped_count
+        **summary
     }
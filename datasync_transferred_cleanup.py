@@ -0,0 +1,265 @@
+import os
+import re
+import json
+import gzip
+import time
+import uuid
+import base64
+import boto3
+from concurrent.futures import ThreadPoolExecutor
+
+EFS_MOUNT_PATH = os.environ.get("EFS_MOUNT_PATH")
+RETENTION_DAYS = os.environ.get("RETENTION_DAYS")
+DELETE_WORKERS = os.environ.get("DELETE_WORKERS", "16")
+PENDING_PATH = os.environ.get("PENDING_PATH")
+DELETE_BATCH_SIZE = 256
+TIMEOUT_BUFFER_SECONDS = 30
+
+if not all([EFS_MOUNT_PATH, RETENTION_DAYS, PENDING_PATH]):
+    raise Exception(
+        "One or more required environment variables are missing: "
+        "EFS_MOUNT_PATH, RETENTION_DAYS, PENDING_PATH"
+    )
+
+EFS_MOUNT_PATH = os.path.normpath(EFS_MOUNT_PATH)
+RETENTION_DAYS = int(RETENTION_DAYS)
+DELETE_WORKERS = max(1, int(DELETE_WORKERS))
+
+if not PENDING_PATH.startswith("s3://"):
+    PENDING_PATH = os.path.normpath(PENDING_PATH)
+
+s3 = boto3.client("s3")
+
+# Text log lines look like "[NOTICE] Transferred file /app/x.gz, 123 bytes".
+TRANSFERRED_FILE = re.compile(r"Transferred file (/.+?)(?:, \d+ bytes)?\s*$")
+
+def decode_log_events(event):
+    data = base64.b64decode(event["awslogs"]["data"])
+    return json.loads(gzip.decompress(data))
+
+# Paths are relative to the DataSync source location, which is the root of
+# the file system, so they map straight onto EFS_MOUNT_PATH. Structured
+# (JSON) log lines carry the path in Source.RelativePath.
+def transferred_path(message):
+    message = message.strip()
+    if message.startswith("{"):
+        try:
+            record = json.loads(message)
+        except json.JSONDecodeError:
+            return None
+        source = record.get("Source") or {}
+        return source.get("RelativePath") or record.get("RelativePath")
+
+    match = TRANSFERRED_FILE.search(message)
+    if match:
+        return match.group(1)
+    return None
+
+# The pending lists are .gz files too. A local PENDING_PATH inside the
+# synced tree is transferred by the next DataSync run; without the check
+# each list would be deferred into a new list, forever.
+def resolve_efs_path(relative_path):
+    full_path = os.path.normpath(
+        os.path.join(EFS_MOUNT_PATH, relative_path.lstrip("/"))
+    )
+    if not full_path.startswith(EFS_MOUNT_PATH + os.sep):
+        return None
+    if full_path.startswith(PENDING_PATH + os.sep):
+        return None
+    return full_path
+
+# Same rules as crm_core_log_cleanup: only .gz files older than
+# RETENTION_DAYS are removed. DataSync has already verified the copy.
+# A file that is still too recent also returns the time it comes due.
+def delete_transferred_file(full_path, now, retention_seconds):
+    if not full_path.endswith(".gz"):
+        return full_path, "not gz", None
+    try:
+        mtime = os.lstat(full_path).st_mtime
+        if now - mtime < retention_seconds:
+            return full_path, "too recent", mtime + retention_seconds
+        os.remove(full_path)
+        return full_path, None, None
+    except FileNotFoundError:
+        return full_path, "already gone", None
+    except Exception as e:
+        return full_path, f"error: {e}", None
+
+# DataSync only transfers changed files, so each file is reported once,
+# while it is still younger than RETENTION_DAYS. Those paths are kept in
+# lists named after the UTC day they come due, under PENDING_PATH (a
+# directory outside the DataSync source location, or s3://bucket/prefix),
+# and deleted by the first invocation on or after that day.
+def pending_location(name):
+    if PENDING_PATH.startswith("s3://"):
+        bucket, _, prefix = PENDING_PATH[5:].partition("/")
+        return bucket, f"{prefix.rstrip('/')}/{name}".lstrip("/")
+    return None, os.path.join(PENDING_PATH, name)
+
+def save_pending(due_day, relative_paths):
+    name = f"{due_day}/{int(time.time())}-{uuid.uuid4().hex}.txt.gz"
+    body = gzip.compress("".join(
+        path + "\n" for path in relative_paths
+    ).encode("utf-8"))
+    bucket, location = pending_location(name)
+    if bucket:
+        s3.put_object(Bucket=bucket, Key=location, Body=body)
+        return
+    os.makedirs(os.path.dirname(location), exist_ok=True)
+    with open(location + ".tmp", "wb") as f:
+        f.write(body)
+    os.replace(location + ".tmp", location)
+
+# Names of the pending lists due on or before today, oldest first.
+def due_pending_lists(today):
+    bucket, root = pending_location("")
+    if bucket:
+        names = []
+        paginator = s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=root):
+            names.extend(
+                obj["Key"][len(root):] for obj in page.get("Contents", [])
+            )
+    else:
+        names = []
+        if os.path.isdir(root):
+            for day in os.listdir(root):
+                if os.path.isdir(os.path.join(root, day)):
+                    names.extend(
+                        f"{day}/{name}"
+                        for name in os.listdir(os.path.join(root, day))
+                    )
+    return sorted(
+        name for name in names
+        if name.endswith(".txt.gz") and name.split("/", 1)[0] <= today
+    )
+
+def load_pending(name):
+    bucket, location = pending_location(name)
+    if bucket:
+        body = s3.get_object(Bucket=bucket, Key=location)["Body"].read()
+    else:
+        with open(location, "rb") as f:
+            body = f.read()
+    return gzip.decompress(body).decode("utf-8").splitlines()
+
+def remove_pending(name):
+    bucket, location = pending_location(name)
+    if bucket:
+        s3.delete_object(Bucket=bucket, Key=location)
+        return
+    os.remove(location)
+    try:
+        os.rmdir(os.path.dirname(location))
+    except OSError:
+        pass
+
+def lambda_handler(event, context):
+    now = time.time()
+    retention_seconds = RETENTION_DAYS * 86400
+    today = time.strftime("%Y-%m-%d", time.gmtime(now))
+
+    def should_stop():
+        if context is None:
+            return False
+        remaining_time_seconds = context.get_remaining_time_in_millis() / 1000
+        return remaining_time_seconds <= TIMEOUT_BUFFER_SECONDS
+
+    # Events without an awslogs payload (e.g. a daily EventBridge schedule)
+    # only work through the pending lists.
+    log_group = None
+    paths = []
+    seen = set()
+    if "awslogs" in (event or {}):
+        payload = decode_log_events(event)
+        log_group = payload.get("logGroup")
+        if payload.get("messageType") != "DATA_MESSAGE":
+            print(f"Ignoring {payload.get('messageType')} message")
+        else:
+            for log_event in payload.get("logEvents", []):
+                relative_path = transferred_path(log_event.get("message", ""))
+                if not relative_path:
+                    continue
+                full_path = resolve_efs_path(relative_path)
+                if not full_path:
+                    print(f"Skipped (outside {EFS_MOUNT_PATH} or a pending list): {relative_path}")
+                    continue
+                if full_path not in seen:
+                    seen.add(full_path)
+                    paths.append(full_path)
+
+    deleted_count = 0
+    skip_reasons = {}
+    deferred = {}
+
+    def delete_batch(executor, batch):
+        nonlocal deleted_count
+        results = executor.map(
+            lambda path: delete_transferred_file(
+                path, now, retention_seconds
+            ),
+            batch
+        )
+        for full_path, reason, due in results:
+            if reason is None:
+                deleted_count += 1
+                continue
+            if reason == "too recent":
+                due_day = time.strftime("%Y-%m-%d", time.gmtime(due))
+                deferred.setdefault(due_day, []).append(
+                    os.path.relpath(full_path, EFS_MOUNT_PATH)
+                )
+            label = reason.split(":", 1)[0]
+            skip_reasons[label] = skip_reasons.get(label, 0) + 1
+            if label == "error":
+                print(f"Error deleting {full_path}: {reason}")
+
+    due_lists_done = 0
+    due_lists = due_pending_lists(today)
+    with ThreadPoolExecutor(max_workers=DELETE_WORKERS) as executor:
+        for start in range(0, len(paths), DELETE_BATCH_SIZE):
+            delete_batch(executor, paths[start:start + DELETE_BATCH_SIZE])
+
+        # A list is removed only once all of its paths were handled; a path
+        # whose file changed since it was listed is deferred again.
+        for name in due_lists:
+            if should_stop():
+                print("Stopping early due to timeout buffer, pending lists left")
+                break
+            due_paths = []
+            for relative_path in load_pending(name):
+                full_path = resolve_efs_path(relative_path)
+                if full_path and full_path not in seen:
+                    seen.add(full_path)
+                    due_paths.append(full_path)
+            for start in range(0, len(due_paths), DELETE_BATCH_SIZE):
+                delete_batch(
+                    executor, due_paths[start:start + DELETE_BATCH_SIZE]
+                )
+            for due_day, relative_paths in deferred.items():
+                save_pending(due_day, relative_paths)
+            deferred.clear()
+            remove_pending(name)
+            due_lists_done += 1
+
+    for due_day, relative_paths in deferred.items():
+        save_pending(due_day, relative_paths)
+    deferred_count = skip_reasons.get("too recent", 0)
+
+    skipped_count = sum(skip_reasons.values())
+    print(
+        f"Log group {log_group}: "
+        f"{len(paths)} transferred files, {due_lists_done} of "
+        f"{len(due_lists)} due lists processed, deleted {deleted_count}, "
+        f"deferred {deferred_count}, "
+        f"skipped {skipped_count} {json.dumps(skip_reasons)}"
+    )
+
+    return {
+        "statusCode": 200,
+        "deleted_count": deleted_count,
+        "deferred_count": deferred_count,
+        "skipped_count": skipped_count,
+        "due_lists_processed": due_lists_done,
+        "skip_reasons": skip_reasons
+    }
@@ -3,14 +3,16 @@ import datetime
 
 efs_mount_path = "/mnt/efs"
 days_threshold_delete = 90
+remove_empty_dirs = os.environ.get("REMOVE_EMPTY_DIRS", "false").lower() == "true"
+keep_dirs = [d.strip("/") for d in os.environ.get("KEEP_DIRS", "").split(",") if d.strip("/")]
 
 def lambda_handler(event, context):
     try:
-        process_directory(efs_mount_path)
+        _, empty_dirs_removed = process_directory(efs_mount_path)
 
         return {
             'statusCode': 200,
-            'body': 'Old gz files deleted successfully.'
+            'body': f'Old gz files deleted successfully. Removed {empty_dirs_removed} empty directories.'
         }
     except Exception as e:
         return {
@@ -27,10 +29,44 @@ def delete_old_file(file_path):
     os.remove(file_path)
     print(f"Deleted: {file_path}")
 
+# The mount root is always kept, and so is every top-level directory
+# unless KEEP_DIRS names the ones to keep.
+def is_kept_directory(directory_path):
+    relative_path = os.path.relpath(directory_path, efs_mount_path)
+    if relative_path == ".":
+        return True
+    if keep_dirs:
+        return relative_path in keep_dirs
+    return os.sep not in relative_path
+
+# rmdir only succeeds on an empty directory, so a file written while the
+# cleanup runs keeps its directory in place.
+def remove_empty_directory(directory_path):
+    if not remove_empty_dirs or is_kept_directory(directory_path):
+        return False
+    try:
+        os.rmdir(directory_path)
+    except OSError:
+        return False
+    print(f"Removed empty directory: {directory_path}")
+    return True
+
+# Returns whether anything was removed below directory_path and how many
+# directories were reclaimed. Directories are only removed bottom-up after
+# this run emptied them.
 def process_directory(directory_path):
+    changed = False
+    empty_dirs_removed = 0
     for entry in os.scandir(directory_path):
         if entry.is_file() and entry.name.endswith('.gz'):
             if calculate_time_difference(entry.path) >= days_threshold_delete:
                 delete_old_file(entry.path)
+                changed = True
         elif entry.is_dir():
-            process_directory(entry.path)
+            child_changed, child_removed = process_directory(entry.path)
+            empty_dirs_removed += child_removed
+            if child_changed:
+                changed = True
+                if remove_empty_directory(entry.path):
+                    empty_dirs_removed += 1
+    return changed, empty_dirs_removed
@@ -1,13 +1,26 @@
 import requests
+from requests.adapters import HTTPAdapter
 from requests_aws4auth import AWS4Auth
 import boto3
 import json
+import gzip
+import uuid
 import hashlib
 import hmac
-import datetime
 import random
 import logging
 import os
+import re
+import time
+import fnmatch
+import zlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Configure logging
 logger = logging.getLogger()
@@ -19,30 +32,196 @@ index_create_url = os.getenv('ELASTICSEARCH_INDEX_URL')
 region = os.getenv('AWS_REGION')
 index_key = os.getenv('INDEX_KEY')
 log_failed_responses = os.getenv('LOG_FAILED_RESPONSES').lower() == 'true'
+bulk_max_bytes = int(os.getenv('BULK_MAX_BYTES', str(5 * 1024 * 1024)))
+bulk_max_docs = int(os.getenv('BULK_MAX_DOCS', '5000'))
+read_chunk_size = int(os.getenv('READ_CHUNK_SIZE', str(1024 * 1024)))
+bulk_concurrency = max(1, int(os.getenv('BULK_CONCURRENCY', '4')))
+record_workers = max(1, int(os.getenv('RECORD_WORKERS', '4')))
+bulk_max_inflight_bytes = int(os.getenv('BULK_MAX_INFLIGHT_BYTES', str(4 * bulk_max_bytes)))
+bulk_max_retries = int(os.getenv('BULK_MAX_RETRIES', '5'))
+backoff_base_seconds = float(os.getenv('BACKOFF_BASE_SECONDS', '0.5'))
+backoff_max_seconds = float(os.getenv('BACKOFF_MAX_SECONDS', '20'))
+http_pool_size = int(os.getenv('HTTP_POOL_SIZE', str(max(10, bulk_concurrency))))
+# Chunks that cannot be indexed are spooled to SPOOL_BUCKET/SPOOL_PREFIX, or
+# to SPOOL_DIR when no bucket is set, and drained later by replay_handler.
+# Chunks whose body is rejected outright (400 or 413) go to its quarantine/
+# folder instead and are never replayed.
+spool_bucket = os.getenv('SPOOL_BUCKET')
+spool_prefix = os.getenv('SPOOL_PREFIX', 'bulk-spool/')
+spool_dir = os.getenv('SPOOL_DIR')
+replay_bytes_per_second = int(os.getenv('REPLAY_BYTES_PER_SECOND', str(5 * 1024 * 1024)))
+replay_time_buffer_seconds = 30
+
+# Routing rules, first match on the Kubernetes namespace wins:
+#   {"namespace": "<glob>", "index": "<template>"} indexes the line; the
+#   template can use {index_key}, {namespace}, {date} and {container}.
+#   Adding "sample": <0..1> keeps only that fraction of the lines.
+#   {"namespace": "<glob>", "drop": true} discards the line.
+# Lines matching no rule are skipped. The default is the original dte- rule.
+default_routing_rules = [{"namespace": "*dte-*", "index": "{index_key}{namespace}_{date}"}]
+routing_rules = json.loads(os.getenv('ROUTING_RULES') or 'null') or default_routing_rules
+
+
+class Route:
+    def __init__(self, rule):
+        if 'namespace' not in rule or bool(rule.get('drop')) == ('index' in rule):
+            raise Exception(f"Routing rule needs a namespace and either an index or drop: {rule}")
+        self.pattern = rule['namespace']
+        self.match = re.compile(fnmatch.translate(self.pattern)).match
+        self.drop = bool(rule.get('drop'))
+        self.index = rule.get('index')
+        sample = rule.get('sample')
+        if sample is not None and not 0 < float(sample) <= 1:
+            raise Exception(f"Routing rule sample must be in (0, 1]: {rule}")
+        # Sampling keys off the document id, so a retried object keeps the
+        # same lines.
+        self.sample_threshold = None if sample is None else int(float(sample) * 2 ** 32)
+        if self.index is not None:
+            try:
+                self.index_name("namespace", "date", "container")
+            except (KeyError, IndexError, ValueError) as e:
+                raise Exception(f"Routing rule has an invalid index template ({e}): {rule}")
+
+    def index_name(self, namespace, date, container):
+        return self.index.format(index_key=index_key, namespace=namespace, date=date, container=container)
+
+    def sampled_out(self, doc_id):
+        return self.sample_threshold is not None and int(doc_id[:8], 16) >= self.sample_threshold
+
+    # The longest literal run of the glob, which the namespace and so the
+    # raw JSON line must contain. Only plain ASCII is used, as anything
+    # else could be escaped in the line.
+    def required_bytes(self):
+        literal = max(re.split(r"\*|\?|\[[^\]]*\]", self.pattern), key=len)
+        if not literal or not re.fullmatch(r"[A-Za-z0-9_.:@ -]+", literal):
+            return None
+        return literal.encode('ascii')
+
+
+# Returns the routes and a prefilter on raw line bytes that is false for
+# lines no indexing rule can match, so they are skipped before JSON decoding.
+# There is no prefilter when an indexing rule has no usable literal.
+def compile_routes(rules):
+    routes = [Route(rule) for rule in rules]
+    literals = set()
+    for route in routes:
+        if route.drop:
+            continue
+        literal = route.required_bytes()
+        if literal is None:
+            return routes, None
+        literals.add(literal)
+    if not literals:
+        return routes, lambda line: False
+    return routes, re.compile(b"|".join(re.escape(literal) for literal in sorted(literals))).search
+
+
+routes, line_prefilter = compile_routes(routing_rules)
+route_cache = {}
+
+
+def route_for(namespace):
+    try:
+        return route_cache[namespace]
+    except KeyError:
+        pass
+    route = next((route for route in routes if route.match(namespace)), None)
+    if len(route_cache) < 10000:
+        route_cache[namespace] = route
+    return route
+
+
+# JSON codec for transform. orjson parses the raw line bytes and returns
+# serialized bytes that go straight into the bulk buffer; without it the
+# stdlib does the same through the same two functions. orjson rejects a few
+# inputs the stdlib accepts (NaN, integers beyond 64 bits, lone surrogates),
+# which fall back. A lone surrogate (a "\ud83d" escape in the log line) has no
+# UTF-8 form, so that line is written with \u escapes instead.
+def stdlib_json_dumps(obj):
+    try:
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    except UnicodeEncodeError:
+        return json.dumps(obj, separators=(',', ':')).encode('ascii')
+
+
+if orjson is not None:
+    def json_loads(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return json.loads(data)
+
+    def json_dumps(obj):
+        try:
+            return orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            return stdlib_json_dumps(obj)
+else:
+    json_loads = json.loads
+    json_dumps = stdlib_json_dumps
+
+# Reused across chunks and warm invocations, so the TLS connection to the
+# domain and the credential lookup are paid once per container.
+http = requests.Session()
+http.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=http_pool_size))
+http.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=http_pool_size))
+credentials = boto3.Session().get_credentials()
+awsauth = None
+awsauth_key = None
 
 def lambda_handler(event, context):
     try:
         logger.info("Lambda function triggered with event: %s", json.dumps(event))
 
-        bucket = event['Records'][0]['s3']['bucket']['name']
-        key = event['Records'][0]['s3']['object']['key']
-        logger.info("Processing file from S3 bucket: %s, key: %s", bucket, key)
+        sources, failed_messages = event_objects(event)
+        sqs_batch = any(record.get('eventSource') == 'aws:sqs' for record in event.get('Records', []))
+
+        # Objects are fetched and transformed by record_workers threads, all
+        # feeding one sender, which bounds the bulk requests in flight for
+        # the whole batch.
+        sender = BulkSender()
+        try:
+            with ThreadPoolExecutor(max_workers=record_workers) as executor:
+                for source, future in [(source, executor.submit(process_object, source, sender)) for source in sources]:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.error("Failed to process s3://%s/%s: %s", source.bucket, source.key, str(e))
+                        source.error = source.error or e
+        finally:
+            sender.close()
+
+        failed = [source for source in sources if source.error is not None]
+        failed_messages.update(source.message_id for source in failed if source.message_id)
+        chunks_posted = sum(source.chunks for source in sources)
+        spooled = sum(source.spooled for source in sources)
+        quarantined = sum(source.quarantined for source in sources)
 
-        params = {'Bucket': bucket, 'Key': key}
-        response = s3.get_object(**params)
-        log_data = response['Body'].read().decode('utf-8')
-        print("Log Data are: ", log_data)
+        if sqs_batch:
+            logger.info("Processed %d objects from %d messages, %d messages failed.",
+                        len(sources), len(event['Records']), len(failed_messages))
+            return {"batchItemFailures": [
+                {"itemIdentifier": record['messageId']}
+                for record in event['Records'] if record.get('messageId') in failed_messages
+            ]}
 
-        elasticsearch_bulk_data = transform(log_data, bucket, key)
-        print("Elasticsearch Bulk Data are: ", elasticsearch_bulk_data)
+        if failed:
+            raise failed[0].error
 
-        if not elasticsearch_bulk_data:
+        if not chunks_posted:
             logger.info("Control message detected. No data to process.")
-            print("Elasticsearch Bulk Data is empty: ", elasticsearch_bulk_data)  # Add print statement here
             return 'Control message handled successfully'
 
-        post(elasticsearch_bulk_data)
-        logger.info("Successfully processed and indexed log data.")
+        if quarantined:
+            logger.warning("Quarantined %d of %d bulk chunks rejected by Elasticsearch.", quarantined, chunks_posted)
+        if spooled:
+            logger.warning("Spooled %d of %d bulk chunks for replay.", spooled, chunks_posted)
+            return f"Spooled {spooled} bulk chunks for replay"
+        if quarantined:
+            return f"Quarantined {quarantined} bulk chunks"
+
+        logger.info("Successfully processed and indexed log data from %d objects in %d bulk requests.",
+                    len(sources), chunks_posted)
 
         return "Success"
     except Exception as e:
@@ -50,83 +229,378 @@ def lambda_handler(event, context):
         raise e
 
 
-def transform(payload, bucket, key):
-    bulk_request_body = ""
-    unique_id = f"{int(datetime.datetime.now().timestamp())}{random.randint(1, 10**18)}{random.randint(1, 10**18)}"
-    
-    fetched_obj = payload.split('\n')
+# One S3 object of the event and the state of its bulk chunks.
+class SourceObject:
+    def __init__(self, bucket, key, message_id=None):
+        self.bucket = bucket
+        self.key = key
+        self.message_id = message_id
+        self.chunks = 0
+        self.inflight = 0
+        self.spooling = False
+        self.spooled = 0
+        self.quarantined = 0
+        self.error = None
+
+
+# Direct S3 notifications carry the object in each record. SQS records wrap
+# an S3 notification in their body, and their messageId is what is reported
+# in batchItemFailures; a body that cannot be parsed fails its message.
+# s3:TestEvent messages hold no objects.
+def event_objects(event):
+    sources = []
+    failed_messages = set()
+    for record in event.get('Records', []):
+        if record.get('eventSource') != 'aws:sqs':
+            sources.append(SourceObject(record['s3']['bucket']['name'], record['s3']['object']['key']))
+            continue
+        try:
+            for s3_record in json.loads(record['body']).get('Records', []):
+                sources.append(SourceObject(
+                    s3_record['s3']['bucket']['name'], s3_record['s3']['object']['key'], record['messageId']
+                ))
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error("Skipping unreadable SQS message %s: %s", record.get('messageId'), str(e))
+            failed_messages.add(record['messageId'])
+    return sources, failed_messages
+
+
+def process_object(source, sender):
+    logger.info("Processing file from S3 bucket: %s, key: %s", source.bucket, source.key)
+    params = {'Bucket': source.bucket, 'Key': source.key}
+    response = s3.get_object(**params)
+    log_lines = read_log_lines(response['Body'], source.key)
+
+    # Each bulk chunk is handed to the sender as soon as transform has
+    # filled it; the sender bounds how many are in flight at once.
+    for elasticsearch_bulk_data in transform(log_lines, source.bucket, source.key):
+        sender.submit(elasticsearch_bulk_data, source)
+        source.chunks += 1
+    sender.wait(source)
+    if source.error is not None:
+        raise source.error
+
+
+# Streams the object body as raw lines (bytes), read_chunk_size bytes at a time.
+# Gzip objects (by .gz suffix or magic bytes) are decompressed on the fly,
+# including files made of several concatenated gzip members.
+def read_log_lines(body, key):
+    chunk = body.read(read_chunk_size)
+    decompressor = None
+    if key.endswith('.gz') or chunk[:2] == b'\x1f\x8b':
+        decompressor = zlib.decompressobj(31)
+
+    tail = b""
+    while chunk:
+        data = chunk
+        if decompressor is not None:
+            data = b""
+            while chunk:
+                data += decompressor.decompress(chunk)
+                chunk = b""
+                if decompressor.eof:
+                    chunk = decompressor.unused_data
+                    decompressor = zlib.decompressobj(31)
+        lines = (tail + data).split(b"\n")
+        tail = lines.pop()
+        yield from lines
+        chunk = body.read(read_chunk_size)
+    if tail:
+        yield tail
+
+
+# The same line of the same object always gets the same _id, so a Lambda
+# retry of the object overwrites documents instead of duplicating them.
+def document_id(bucket, key, line_number):
+    return hashlib.blake2b(f"{bucket}/{key}:{line_number}".encode('utf-8'), digest_size=16).hexdigest()
+
+
+# Yields _bulk request bodies (bytes) of at most bulk_max_docs documents and,
+# unless a single document is larger, bulk_max_bytes bytes.
+def transform(lines, bucket, key):
+    bulk_request_body = bytearray()
+    bulk_docs = 0
+
     count = -1
-    service = 'es'
-    credentials = boto3.Session().get_credentials()
-    awsauth = AWS4Auth(credentials.access_key, credentials.secret_key, region, service, session_token=credentials.token)
+    indexed = 0
+    skipped = 0
 
-    for k in fetched_obj:
+    for k in lines:
         count += 1
         if k.strip():
+            if line_prefilter is not None and not line_prefilter(k):
+                skipped += 1
+                continue
             try:
-                parsed_data = json.loads(k)
-                logger.debug(f"Processing log entry: {json.dumps(parsed_data)}")  # Debugging log entry
-            except json.JSONDecodeError as e:
+                parsed_data = json_loads(k)
+                logger.debug("Processing log entry: %s", k)
+            except ValueError as e:
                 logger.warning("Skipping invalid JSON entry: %s, Error: %s", k, str(e))
                 continue
 
-            index_name = ''
-            namespace = parsed_data.get('kubernetes', {}).get('namespace_name', '')
-            if 'dte-' in namespace:
-                date = parsed_data.get('date', '').split('T')[0]
-                index_name = f"{index_key}{namespace}_{date}"
-                log_line = parsed_data.get('log', '')
+            kubernetes = parsed_data.get('kubernetes', {})
+            namespace = kubernetes.get('namespace_name', '')
+            route = route_for(namespace)
+            if route is None or route.drop:
+                logger.debug("Skipping entry as no routing rule indexes namespace %s", namespace)
+                skipped += 1
+                continue
 
-                if not index_name or not log_line:
-                    logger.warning("Missing necessary fields: index_name or log_line are empty for entry: %s", k)
-                    continue
+            doc_id = document_id(bucket, key, count)
+            if route.sampled_out(doc_id):
+                skipped += 1
+                continue
 
-                actions = {"index": {"_index": index_name, "_id": f"{unique_id}{count}"}}
-                source = {
-                    "kubernetes": parsed_data.get('kubernetes', {}),
-                    "ms-name": parsed_data.get('kubernetes', {}).get('container_name', ''),
-                    "log": log_line,
-                    "cluster_name": parsed_data.get('cluster_name', ''),
-                    "@id": f"{unique_id}{count}",
-                    "@timestamp": parsed_data.get('date', ''),
-                    "@owner": '',
-                    "@log_group": bucket,
-                    "@log_stream": key
-                }
+            date = parsed_data.get('date', '').split('T')[0]
+            index_name = route.index_name(namespace, date, kubernetes.get('container_name', ''))
+            log_line = parsed_data.get('log', '')
 
-                bulk_request_body += "\n".join([json.dumps(actions), json.dumps(source)]) + "\n"
-            else:
-                logger.debug(f"Skipping entry as namespace doesn't match 'dte-': {parsed_data}")
+            if not index_name or not log_line:
+                logger.warning("Missing necessary fields: index_name or log_line are empty for entry: %s", k)
+                continue
+
+            actions = {"index": {"_index": index_name, "_id": doc_id}}
+            source = {
+                "kubernetes": kubernetes,
+                "ms-name": kubernetes.get('container_name', ''),
+                "log": log_line,
+                "cluster_name": parsed_data.get('cluster_name', ''),
+                "@id": doc_id,
+                "@timestamp": parsed_data.get('date', ''),
+                "@owner": '',
+                "@log_group": bucket,
+                "@log_stream": key
+            }
+
+            action_line = json_dumps(actions)
+            source_line = json_dumps(source)
+            doc_size = len(action_line) + len(source_line) + 2
+            if bulk_docs and (len(bulk_request_body) + doc_size > bulk_max_bytes or bulk_docs >= bulk_max_docs):
+                yield bytes(bulk_request_body)
+                bulk_request_body.clear()
+                bulk_docs = 0
+            bulk_request_body += action_line
+            bulk_request_body += b"\n"
+            bulk_request_body += source_line
+            bulk_request_body += b"\n"
+            bulk_docs += 1
+            indexed += 1
 
-    logger.info("Transformed %d log entries for indexing.", count + 1)
-    logger.debug(f"Final Elasticsearch Bulk Data: {bulk_request_body}")  # Debugging the bulk data
-    return bulk_request_body
+    if bulk_docs:
+        yield bytes(bulk_request_body)
+
+    logger.info("Transformed %d log entries for indexing: %d indexed, %d skipped by routing.", count + 1, indexed, skipped)
 
 
 ################################### POST ##################################
-def post(body):
-    service = 'es'
-    credentials = boto3.Session().get_credentials()
-    awsauth = AWS4Auth(credentials.access_key, credentials.secret_key, region, service, session_token=credentials.token)
+# get_frozen_credentials only refreshes role credentials when they are close
+# to expiry, so the signer is rebuilt only when the keys actually change.
+def get_awsauth():
+    global awsauth, awsauth_key
+    frozen = credentials.get_frozen_credentials()
+    if awsauth is None or awsauth_key != frozen:
+        awsauth = AWS4Auth(frozen.access_key, frozen.secret_key, region, 'es', session_token=frozen.token)
+        awsauth_key = frozen
+    return awsauth
+
 
+# Keeps up to `limit` _bulk requests and bulk_max_inflight_bytes in flight
+# across all objects of the invocation. The limit follows AIMD: it is halved
+# whenever OpenSearch pushes back and grows by one after each accepted
+# request, up to bulk_concurrency. The first failed request of an object
+# stops further submissions for that object and is raised by wait. When a
+# spool is configured, undeliverable items are spooled instead and every
+# later chunk of the object is spooled without being posted.
+class BulkSender:
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=bulk_concurrency)
+        self.condition = threading.Condition()
+        self.limit = bulk_concurrency
+        self.inflight = 0
+        self.inflight_bytes = 0
+
+    def spool(self, body, source, reason, failed_items=()):
+        spool_chunk(body, {
+            "bucket": source.bucket, "key": source.key,
+            "reason": reason, "errors": error_counts(failed_items)
+        })
+        with self.condition:
+            source.spooling = True
+            source.spooled += 1
+
+    def submit(self, body, source):
+        if source.spooling:
+            self.spool(body, source, "not sent, an earlier chunk of the object failed")
+            return
+        with self.condition:
+            while source.error is None and self.inflight and (
+                    self.inflight >= self.limit
+                    or self.inflight_bytes + len(body) > bulk_max_inflight_bytes):
+                self.condition.wait()
+            if source.error is not None:
+                raise source.error
+            self.inflight += 1
+            self.inflight_bytes += len(body)
+            source.inflight += 1
+        self.executor.submit(self.send, body, source)
+
+    def send(self, body, source):
+        try:
+            try:
+                post(body, self)
+            except BulkIndexingError as e:
+                if not spool_enabled():
+                    raise
+                if e.body:
+                    self.spool(e.body, source, str(e), e.failed_items)
+                else:
+                    logger.error("Dropped %d items that cannot be indexed: %s",
+                                 len(e.failed_items), json.dumps(error_counts(e.failed_items)))
+            except requests.exceptions.RequestException as e:
+                if not spool_enabled():
+                    raise
+                if is_permanent_failure(e):
+                    # Resending cannot help and later chunks of the object
+                    # are unaffected, so only this chunk is set aside.
+                    spool_chunk(body, {"bucket": source.bucket, "key": source.key, "reason": str(e), "errors": {}},
+                                quarantine=True)
+                    with self.condition:
+                        source.quarantined += 1
+                else:
+                    self.spool(body, source, str(e))
+        except Exception as e:
+            with self.condition:
+                if source.error is None:
+                    source.error = e
+        finally:
+            with self.condition:
+                self.inflight -= 1
+                self.inflight_bytes -= len(body)
+                source.inflight -= 1
+                self.condition.notify_all()
+
+    def wait(self, source):
+        with self.condition:
+            while source.inflight:
+                self.condition.wait()
+
+    def rejected(self):
+        with self.condition:
+            if self.limit > 1:
+                self.limit //= 2
+                logger.warning("Elasticsearch pushed back, bulk concurrency lowered to %d", self.limit)
+
+    def accepted(self):
+        with self.condition:
+            if self.limit < bulk_concurrency:
+                self.limit += 1
+                self.condition.notify_all()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+# Carries the items that were still retryable when post gave up, as a bulk
+# body that can be resent as is, and every failed item from the response.
+class BulkIndexingError(Exception):
+    def __init__(self, message, body, failed_items):
+        super().__init__(message)
+        self.body = body
+        self.failed_items = failed_items
+
+
+def error_counts(failed_items):
+    counts = {}
+    for item in failed_items:
+        error_type = item.get('index', {}).get('error', {}).get('type', 'unknown')
+        counts[error_type] = counts.get(error_type, 0) + 1
+    return counts
+
+
+retryable_statuses = {429, 502, 503, 504}
+
+
+def is_retryable(result):
+    return result.get('status') in retryable_statuses or result.get('error', {}).get('type') == 'es_rejected_execution_exception'
+
+
+permanent_statuses = {400, 413}
+
+
+# A malformed (400) or oversized (413) body fails the same way every time
+# the chunk is sent. Other 4xx responses, such as 401 or 403 from an expired
+# credential or a passing permission problem, are spooled for replay.
+def is_permanent_failure(error):
+    response = getattr(error, 'response', None)
+    return response is not None and response.status_code in permanent_statuses
+
+
+# Throttled or unavailable responses resend the chunk, and items that fail
+# with a retryable status are resent on their own, after a capped full-jitter
+# exponential backoff. Items with any other error are not retried. The
+# invocation fails only for items that still fail once retries run out.
+def post(body, sender=None):
+    attempted = body.count(b"\n") // 2
+    failed_items = []
+    leftover = b""
     try:
-        response = requests.post(host, auth=awsauth, data=body, headers={"Content-Type": "application/x-ndjson"})
-        response.raise_for_status()  # Raises an exception for HTTP 4xx/5xx
+        for attempt in range(bulk_max_retries + 1):
+            if attempt:
+                delay = random.uniform(0, min(backoff_max_seconds, backoff_base_seconds * 2 ** attempt))
+                logger.warning("Retrying %d bulk items in %.2fs (attempt %d)", body.count(b"\n") // 2, delay, attempt + 1)
+                time.sleep(delay)
+
+            response = http.post(host, auth=get_awsauth(), data=body, headers={"Content-Type": "application/x-ndjson"})
+            if response.status_code in retryable_statuses:
+                if sender is not None:
+                    sender.rejected()
+                continue
+            response.raise_for_status()  # Raises an exception for HTTP 4xx/5xx
+
+            info = response.json()
+            items = info.get('items', [])
+            retry = []
+            for position, item in enumerate(items):
+                result = item.get('index', {})
+                if result.get('status', 0) < 300:
+                    continue
+                if is_retryable(result):
+                    retry.append(position)
+                else:
+                    failed_items.append(item)
+
+            if not retry:
+                if sender is not None:
+                    sender.accepted()
+                break
+            if sender is not None:
+                sender.rejected()
+            lines = body.split(b"\n")
+            body = b"".join(lines[2 * position] + b"\n" + lines[2 * position + 1] + b"\n" for position in retry)
+            if attempt == bulk_max_retries:
+                failed_items.extend(items[position] for position in retry)
+                leftover = body
+
+        if response.status_code in retryable_statuses:
+            raise BulkIndexingError(
+                f"Elasticsearch rejected the bulk request with status {response.status_code}",
+                body, failed_items
+            )
 
-        info = response.json()
-        failed_items = [x for x in info.get('items', []) if x.get('index', {}).get('status', 0) >= 300]
-        
         success = {
-            "attemptedItems": len(info.get('items', [])),
-            "successfulItems": len(info.get('items', [])) - len(failed_items),
+            "attemptedItems": attempted,
+            "successfulItems": attempted - len(failed_items),
             "failedItems": len(failed_items)
         }
 
-        if info.get('errors', False):
-            del info['items']
+        if failed_items:
+            info.pop('items', None)
             error = {"statusCode": response.status_code, "responseBody": info}
             log_failure(error, failed_items)
-            raise Exception(f"Elasticsearch indexing failed with status {response.status_code}")
+            raise BulkIndexingError(
+                f"Elasticsearch indexing failed for {len(failed_items)} of {attempted} items",
+                leftover, failed_items
+            )
 
         logger.info("Elasticsearch indexing successful: %s", json.dumps(success))
 
@@ -135,6 +609,120 @@ def post(body):
         raise e
 
 
+################################### SPOOL #################################
+def spool_enabled():
+    return bool(spool_bucket or spool_dir)
+
+
+# A spool entry is one gzip file: a JSON metadata line followed by the bulk
+# body exactly as it would be posted, so replaying it needs no re-parsing.
+# Quarantined entries keep the same format under quarantine/ for inspection.
+def spool_chunk(body, metadata, quarantine=False):
+    metadata = dict(metadata, items=body.count(b"\n") // 2, spooled_at=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))
+    data = gzip.compress(json.dumps(metadata).encode('utf-8') + b"\n" + body, compresslevel=6)
+    name = f"{int(time.time() * 1000):015d}-{uuid.uuid4().hex}.ndjson.gz"
+    if quarantine:
+        name = "quarantine/" + name
+    if spool_bucket:
+        s3.put_object(Bucket=spool_bucket, Key=spool_prefix + name, Body=data)
+        location = f"s3://{spool_bucket}/{spool_prefix}{name}"
+    else:
+        location = os.path.join(spool_dir, name)
+        os.makedirs(os.path.dirname(location), exist_ok=True)
+        with open(location + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(location + ".tmp", location)
+    logger.warning("%s %d bulk items to %s: %s", "Quarantined" if quarantine else "Spooled",
+                   metadata['items'], location, metadata['reason'])
+    return location
+
+
+# Entry names sort oldest first. Quarantined entries are not listed.
+def list_spool():
+    if spool_bucket:
+        names = []
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=spool_bucket, Prefix=spool_prefix):
+            names.extend(obj['Key'][len(spool_prefix):] for obj in page.get('Contents', []))
+        return sorted(name for name in names if name.endswith('.ndjson.gz') and '/' not in name)
+    if not os.path.isdir(spool_dir):
+        return []
+    return sorted(name for name in os.listdir(spool_dir) if name.endswith('.ndjson.gz'))
+
+
+def read_spool(name):
+    if spool_bucket:
+        data = s3.get_object(Bucket=spool_bucket, Key=spool_prefix + name)['Body'].read()
+    else:
+        with open(os.path.join(spool_dir, name), "rb") as f:
+            data = f.read()
+    metadata, body = gzip.decompress(data).split(b"\n", 1)
+    return json.loads(metadata), body
+
+
+def delete_spool(name):
+    if spool_bucket:
+        s3.delete_object(Bucket=spool_bucket, Key=spool_prefix + name)
+    else:
+        os.remove(os.path.join(spool_dir, name))
+
+
+# Drains the spool oldest first, one chunk at a time and no faster than
+# REPLAY_BYTES_PER_SECOND. Items that fail with a non-retryable error are
+# dropped, as they would fail again, and a chunk whose body is rejected
+# outright (400 or 413) is quarantined. Replay stops at the first chunk that
+# still cannot be delivered (a transport error, 401/403, 429 or 5xx),
+# respooling what is left of it, since the cluster has not recovered yet.
+def replay_handler(event, context):
+    if not spool_enabled():
+        raise Exception("SPOOL_BUCKET or SPOOL_DIR must be set to replay spooled chunks")
+
+    replayed = 0
+    quarantined = 0
+    items = 0
+    sent_bytes = 0
+    started = time.monotonic()
+    names = list_spool()
+    logger.info("Replaying %d spooled bulk chunks.", len(names))
+
+    for name in names:
+        if context is not None and context.get_remaining_time_in_millis() / 1000 <= replay_time_buffer_seconds:
+            logger.info("Stopping replay before the Lambda timeout.")
+            break
+
+        metadata, body = read_spool(name)
+        try:
+            post(body)
+        except BulkIndexingError as e:
+            if e.body:
+                spool_chunk(e.body, dict(metadata, reason=str(e), errors=error_counts(e.failed_items)))
+                delete_spool(name)
+                logger.warning("Elasticsearch is still failing, stopping replay: %s", e)
+                break
+            logger.error("Dropped %d items of %s that cannot be indexed: %s",
+                         len(e.failed_items), name, json.dumps(error_counts(e.failed_items)))
+        except requests.exceptions.RequestException as e:
+            if not is_permanent_failure(e):
+                logger.warning("Elasticsearch is still failing, stopping replay: %s", e)
+                break
+            spool_chunk(body, dict(metadata, reason=str(e), errors={}), quarantine=True)
+            delete_spool(name)
+            quarantined += 1
+            continue
+
+        delete_spool(name)
+        replayed += 1
+        items += metadata.get('items', 0)
+        sent_bytes += len(body)
+        delay = started + sent_bytes / replay_bytes_per_second - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    remaining = len(list_spool())
+    logger.info("Replayed %d spooled chunks (%d items), quarantined %d, %d left.", replayed, items, quarantined, remaining)
+    return {"replayed": replayed, "items": items, "quarantined": quarantined, "remaining": remaining}
+
+
 def log_failure(error, failed_items):
     global log_failed_responses
     if log_failed_responses:
@@ -2,84 +2,674 @@ import os
 import boto3
 import csv
 import gzip
+import zlib
+import io
+import json
+import hashlib
+import mmap
+import uuid
 import time
+import datetime
+import threading
+from array import array
+from bisect import bisect_left
+from collections import deque
+from itertools import islice
+from operator import methodcaller
+from urllib.parse import unquote_to_bytes
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+try:
+    import pyarrow
+    import pyarrow.compute as pyarrow_compute
+    import pyarrow.orc as pyarrow_orc
+    import pyarrow.parquet as pyarrow_parquet
+except ImportError:
+    pyarrow = None
 
 EFS_MOUNT_PATH = os.environ.get("EFS_MOUNT_PATH")
 INVENTORY_BUCKET = os.environ.get("INVENTORY_BUCKET")
 INVENTORY_PREFIX = os.environ.get("INVENTORY_PREFIX")
 RETENTION_DAYS = os.environ.get("RETENTION_DAYS")
+TIMEOUT_BUFFER_SECONDS = 30
+WALKER_WORKERS = os.environ.get("WALKER_WORKERS", "16")
+REMOVE_EMPTY_DIRS = os.environ.get("REMOVE_EMPTY_DIRS", "false").lower() == "true"
+KEEP_DIRS = {
+    path.strip("/")
+    for path in os.environ.get("KEEP_DIRS", "").split(",")
+    if path.strip("/")
+}
+EMPTY_DIR_BATCH_SIZE = 256
+# Optional fixed cap on EFS metadata operations per second; unset or 0
+# leaves throttling to the latency-driven IOGovernor.
+EFS_MAX_OPS_PER_SECOND = float(os.environ.get("EFS_MAX_OPS_PER_SECOND", "0"))
+EFS_MIN_OPS_PER_SECOND = float(os.environ.get("EFS_MIN_OPS_PER_SECOND", "100"))
+EFS_LATENCY_THRESHOLD_MS = float(os.environ.get("EFS_LATENCY_THRESHOLD_MS", "50"))
+GOVERNOR_ADJUST_SECONDS = 0.5
+INVENTORY_WORKERS = max(1, int(os.environ.get("INVENTORY_WORKERS", "8")))
+INVENTORY_LOOKBACK_DAYS = int(os.environ.get("INVENTORY_LOOKBACK_DAYS", "7"))
+INVENTORY_CACHE_DIR = os.environ.get("INVENTORY_CACHE_DIR", "/tmp")
+INVENTORY_READ_SIZE = 1024 * 1024
+INVENTORY_INDEX_FORMAT = 2
+BACKUP_BUCKET = os.environ.get("BACKUP_BUCKET")
+HEAD_OBJECT_THRESHOLD = int(os.environ.get("HEAD_OBJECT_THRESHOLD", "5000")) if BACKUP_BUCKET else 0
+HEAD_OBJECT_WORKERS = max(1, int(os.environ.get("HEAD_OBJECT_WORKERS", "32")))
 
 if not all([EFS_MOUNT_PATH, INVENTORY_BUCKET, INVENTORY_PREFIX, RETENTION_DAYS]):
     raise Exception("One or more required environment variables are missing: EFS_MOUNT_PATH, INVENTORY_BUCKET, INVENTORY_PREFIX, RETENTION_DAYS")
 
 RETENTION_DAYS = int(RETENTION_DAYS)
+WALKER_WORKERS = max(1, int(WALKER_WORKERS))
 
 s3 = boto3.client("s3")
+head_s3 = boto3.client("s3", config=Config(max_pool_connections=HEAD_OBJECT_WORKERS))
+inventory_indexes = {}
 
+# S3 Inventory delivers each run to <prefix>/<YYYY-MM-DDTHH-MMZ>/ as a
+# manifest.json listing the gzip CSV data files. The newest manifest is found
+# by listing one day's prefix at a time, starting today. A prefix holding a
+# single CSV and no manifest falls back to its newest object; one whose
+# manifests are all older than INVENTORY_LOOKBACK_DAYS uses the newest one.
 def get_latest_inventory_key():
+    prefix = INVENTORY_PREFIX.rstrip("/") + "/"
+    today = datetime.datetime.now(datetime.timezone.utc).date()
     paginator = s3.get_paginator("list_objects_v2")
+    for days in range(INVENTORY_LOOKBACK_DAYS + 1):
+        day = (today - datetime.timedelta(days=days)).isoformat()
+        manifests = [
+            obj["Key"]
+            for page in paginator.paginate(Bucket=INVENTORY_BUCKET, Prefix=prefix + day)
+            for obj in page.get("Contents", [])
+            if obj["Key"].endswith("/manifest.json")
+        ]
+        if manifests:
+            return max(manifests)
+
     latest = None
+    latest_manifest = None
     for page in paginator.paginate(Bucket=INVENTORY_BUCKET, Prefix=INVENTORY_PREFIX):
         for obj in page.get("Contents", []):
-            if not latest or obj["LastModified"] > latest["LastModified"]:
+            if obj["Key"].endswith("/manifest.json"):
+                if not latest_manifest or obj["LastModified"] > latest_manifest["LastModified"]:
+                    latest_manifest = obj
+            elif not latest or obj["LastModified"] > latest["LastModified"]:
                 latest = obj
-    if latest:
-        return latest["Key"]
+    if latest_manifest:
+        print(f"No inventory manifest within {INVENTORY_LOOKBACK_DAYS} days, using {latest_manifest['Key']}")
+        return latest_manifest["Key"]
+    if not latest:
+        raise Exception(f"No inventory manifest or CSV found under s3://{INVENTORY_BUCKET}/{INVENTORY_PREFIX}")
+    return latest["Key"]
+
+# Returns the (data key, md5) pairs behind an inventory key plus the layout
+# to read them with. Manifest CSV data files have no header row and carry
+# URL-encoded keys; Parquet and ORC data files name the column "key". The
+# manifest itself is checked against manifest.checksum.
+def load_inventory_files(inventory_key):
+    if not inventory_key.endswith("manifest.json"):
+        return [(inventory_key, None)], {"format": "CSV", "header": True, "url_encoded": False, "key": 1}
+
+    body = s3.get_object(Bucket=INVENTORY_BUCKET, Key=inventory_key)["Body"].read()
+    checksum_key = inventory_key[:-len("manifest.json")] + "manifest.checksum"
+    checksum = s3.get_object(Bucket=INVENTORY_BUCKET, Key=checksum_key)["Body"].read()
+    if hashlib.md5(body).hexdigest() != checksum.decode("utf-8").strip():
+        raise Exception(f"Inventory manifest {inventory_key} failed its MD5 check")
+
+    manifest = json.loads(body)
+    file_format = manifest.get("fileFormat", "CSV")
+    if file_format == "CSV":
+        columns = [column.strip() for column in manifest["fileSchema"].split(",")]
+        layout = {"format": file_format, "header": False, "url_encoded": True, "columns": len(columns), "key": columns.index("Key")}
+    elif file_format in ("Parquet", "ORC"):
+        if pyarrow is None:
+            raise Exception(f"pyarrow is required to read {file_format} inventories")
+        layout = {"format": file_format, "key": "key"}
+    else:
+        raise Exception(f"Unsupported inventory format: {file_format}")
+    files = [(entry["key"], entry.get("MD5checksum")) for entry in manifest["files"]]
+    return files, layout
+
+# Hashes the compressed bytes as gzip pulls them off the response body.
+class MD5Reader:
+    def __init__(self, body):
+        self.body = body
+        self.digest = hashlib.md5()
+
+    def read(self, size=-1):
+        data = self.body.read(size)
+        self.digest.update(data)
+        return data
+
+# Key hashes are 8-byte BLAKE2b digests, read little-endian (the byte order of
+# Lambda's x86_64 and arm64), with the top three bits forced to 001. That makes
+# every hash also the bit pattern of a positive, normal double, and those sort
+# in the same order as the integers, so the index build sorts them as floats,
+# which is about twice as fast as sorting Python ints. Copying a ready BLAKE2b
+# state is cheaper than building one per key.
+KEY_HASH_STATE = hashlib.blake2b(digest_size=8)
+KEY_HASH_TOP_BYTE = bytes(0x20 | (value & 0x1F) for value in range(256))
+
+def blake2b_64(data):
+    state = KEY_HASH_STATE.copy()
+    state.update(data)
+    return state.digest()
+
+def key_hash(data):
+    return int.from_bytes(blake2b_64(data), "little") & 0x1FFFFFFFFFFFFFFF | 0x2000000000000000
+
+# The hashes of a batch of raw keys as packed doubles: the digests are joined
+# and the top byte of each is fixed up in a single translate over a strided
+# slice.
+def key_digests(keys):
+    digests = bytearray(b"".join(map(blake2b_64, keys)))
+    digests[7::8] = digests[7::8].translate(KEY_HASH_TOP_BYTE)
+    return array("d", digests)
+
+# Yields blocks of whole lines, decompressing a megabyte of the gzip stream at
+# a time. Concatenated gzip members are followed through.
+def read_gzip_blocks(body):
+    decompressor = zlib.decompressobj(31)
+    tail = b""
+    while True:
+        chunk = body.read(INVENTORY_READ_SIZE)
+        if not chunk:
+            break
+        while chunk:
+            block = tail + decompressor.decompress(chunk)
+            end = block.rfind(b"\n") + 1
+            tail = block[end:]
+            if end:
+                yield block[:end]
+            chunk = b""
+            if decompressor.eof:
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(31)
+    if tail:
+        yield tail
+
+# Manifest CSV data files quote every field and URL-encode the key, so no field
+# holds a quote, a comma or a newline: splitting a whole block on "," leaves
+# columns - 1 pieces per row with the (unquoted) key at a fixed stride, and the
+# keys are hashed without ever being decoded. A block whose pieces do not add
+# up is split line by line instead. A single CSV with a header row still goes
+# through the csv module. Keys that are not .gz files are dropped first.
+def read_csv_hashes(data_key, md5, layout):
+    response = s3.get_object(Bucket=INVENTORY_BUCKET, Key=data_key)
+    body = MD5Reader(response["Body"])
+    key_column = layout["key"]
+    hashes = array("d")
+    if layout["url_encoded"]:
+        columns = layout["columns"]
+        split_row = methodcaller("split", b",", key_column + 1)
+        for block in read_gzip_blocks(body):
+            rows = block.count(b"\n") + (not block.endswith(b"\n"))
+            fields = block.split(b'","')
+            if 0 < key_column < columns - 1 and len(fields) == rows * (columns - 1) + 1:
+                keys = [key for key in fields[key_column::columns - 1] if key.endswith(b".gz")]
+            else:
+                keys = [row[key_column].strip(b'"') for row in map(split_row, block.split(b"\n"))
+                        if len(row) > key_column and row[key_column].endswith((b'.gz"', b".gz"))]
+            encoded = b"".join(keys)
+            if b"%" in encoded or b"+" in encoded:
+                keys = [unquote_to_bytes(key.replace(b"+", b" ")) if b"%" in key or b"+" in key else key for key in keys]
+            hashes.extend(key_digests(keys))
     else:
-        raise Exception("No inventory file found in S3.")
+        with gzip.GzipFile(fileobj=body) as gz:
+            text = io.TextIOWrapper(io.BufferedReader(gz, INVENTORY_READ_SIZE), encoding="utf-8", newline="")
+            reader = csv.reader(text)
+            next(reader)
+            while True:
+                rows = list(islice(reader, 65536))
+                if not rows:
+                    break
+                hashes.extend(key_digests([row[key_column].encode("utf-8") for row in rows if row[key_column].endswith(".gz")]))
+    while body.read(INVENTORY_READ_SIZE):
+        pass
+    if md5 and body.digest.hexdigest() != md5:
+        raise Exception(f"Inventory data file {data_key} failed its MD5 check")
+    return hashes
 
+# Parquet and ORC need random access to their footer, so the data file is
+# read into memory. Only the key column is decoded and the .gz filter runs
+# inside pyarrow on each record batch.
+def read_columnar_hashes(data_key, md5, layout):
+    data = s3.get_object(Bucket=INVENTORY_BUCKET, Key=data_key)["Body"].read()
+    if md5 and hashlib.md5(data).hexdigest() != md5:
+        raise Exception(f"Inventory data file {data_key} failed its MD5 check")
+    source = pyarrow.BufferReader(data)
+    if layout["format"] == "Parquet":
+        batches = pyarrow_parquet.ParquetFile(source).iter_batches(batch_size=65536, columns=[layout["key"]])
+    else:
+        orc_file = pyarrow_orc.ORCFile(source)
+        batches = (orc_file.read_stripe(stripe, columns=[layout["key"]]) for stripe in range(orc_file.nstripes))
+    hashes = array("d")
+    for batch in batches:
+        keys = batch.column(layout["key"])
+        keys = keys.filter(pyarrow_compute.ends_with(keys, ".gz"))
+        hashes.extend(key_digests(keys.cast(pyarrow.binary()).to_pylist()))
+    return hashes
+
+def read_inventory_hashes(data_key, md5, layout):
+    if layout["format"] == "CSV":
+        return read_csv_hashes(data_key, md5, layout)
+    return read_columnar_hashes(data_key, md5, layout)
+
+# Sorted 61-bit key hashes of the inventory keys, memory-mapped from the index
+# file: membership is a binary search and the keys never exist as Python
+# strings. At ten million keys the chance of a file outside the inventory
+# matching one of them is about 1 in 2 * 10^11.
+class InventoryIndex:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size % 8:
+                raise ValueError(f"Truncated inventory index {path}")
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self.hashes = memoryview(self.map or b"").cast("Q")
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, key):
+        value = key_hash(key.encode("utf-8", "surrogateescape"))
+        position = bisect_left(self.hashes, value)
+        return position < len(self.hashes) and self.hashes[position] == value
+
+# Index files are named after the inventory source, the inventory key + ETag
+# and the index format, so a new inventory never reuses an old index. The
+# data files are parsed through a bounded pool and the index is written to a
+# temporary file first, so a concurrent reader never sees a partial one.
+def build_inventory_index(inventory_key, etag):
+    source = hashlib.sha1(f"{INVENTORY_BUCKET}/{INVENTORY_PREFIX}".encode("utf-8")).hexdigest()[:12]
+    version = hashlib.sha1(f"{inventory_key}:{etag}:{INVENTORY_INDEX_FORMAT}".encode("utf-8")).hexdigest()[:16]
+    path = os.path.join(INVENTORY_CACHE_DIR, f"inventory-{source}-{version}.idx")
+    if os.path.exists(path):
+        print(f"Reusing inventory index {path}")
+        return path
+
+    files, layout = load_inventory_files(inventory_key)
+    hashes = array("d")
+    with ThreadPoolExecutor(max_workers=INVENTORY_WORKERS) as executor:
+        for file_hashes in executor.map(lambda f: read_inventory_hashes(*f, layout), files):
+            hashes.extend(file_hashes)
+    hashes = array("d", sorted(hashes))
+
+    os.makedirs(INVENTORY_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        hashes.tofile(f)
+    os.replace(tmp_path, path)
+    print(f"Indexed {len(hashes)} inventory keys from {len(files)} data files")
+
+    cutoff = time.time() - 86400
+    for entry in os.scandir(INVENTORY_CACHE_DIR):
+        if entry.name.startswith(f"inventory-{source}-") and entry.path != path:
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                continue
+    return path
+
+# The inventory only changes once a day, so its index is kept in module scope
+# for warm starts and on disk (INVENTORY_CACHE_DIR) for cold starts.
 def load_inventory_keys(inventory_key):
-    response = s3.get_object(Bucket=INVENTORY_BUCKET, Key=inventory_key)
-    keys = set()
-    with gzip.GzipFile(fileobj=response["Body"]) as gz:
-        reader = csv.reader(line.decode("utf-8") for line in gz)
-        next(reader)
-        for row in reader:
-            keys.add(row[1])
-    return keys
+    etag = s3.head_object(Bucket=INVENTORY_BUCKET, Key=inventory_key)["ETag"].strip('"')
+    if (inventory_key, etag) not in inventory_indexes:
+        index = InventoryIndex(build_inventory_index(inventory_key, etag))
+        inventory_indexes.clear()
+        inventory_indexes[(inventory_key, etag)] = index
+    return inventory_indexes[(inventory_key, etag)]
+
+# Confirms a candidate against the backup bucket itself rather than the last
+# inventory. Returns None when the object exists with the same size,
+# otherwise why the file is kept.
+def head_object_check(s3_key, size):
+    try:
+        response = head_s3.head_object(Bucket=BACKUP_BUCKET, Key=s3_key)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return "not in S3"
+        return f"HeadObject failed: {e}"
+    if response["ContentLength"] != size:
+        return "size mismatch"
+    return None
+
+# Shared by every walker thread and kept across warm invocations. Each
+# metadata operation (directory listing, stat, unlink, rmdir) takes a slot
+# at the current rate limit. The EWMA of per-operation latency drives an
+# AIMD loop: the rate halves while latency is above the threshold and
+# climbs back by a tenth of the ceiling while it is below. The ceiling is
+# EFS_MAX_OPS_PER_SECOND when it is set (a fixed cap, off by default);
+# otherwise there is no limit until latency first crosses the threshold,
+# the measured rate at that point becomes the ceiling, and the limit is
+# lifted again once the rate climbs back to it.
+class IOGovernor:
+    def __init__(self, max_ops_per_second, min_ops_per_second, latency_threshold_ms):
+        self.max_rate = max_ops_per_second or None
+        self.min_rate = min(min_ops_per_second, self.max_rate or min_ops_per_second)
+        self.rate = self.max_rate
+        self.ceiling = self.max_rate
+        self.threshold = latency_threshold_ms / 1000
+        self.latency = None
+        self.throttled_seconds = 0.0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+        self.next_adjustment = self.next_slot + GOVERNOR_ADJUST_SECONDS
+        self.window_start = self.next_slot
+        self.window_ops = 0
+
+    def acquire(self):
+        with self.lock:
+            self.window_ops += 1
+            if self.rate is None:
+                return
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + 1 / self.rate
+            delay = slot - now
+            self.throttled_seconds += delay
+        if delay > 0:
+            time.sleep(delay)
+
+    def record(self, elapsed, weight=1):
+        latency = elapsed / weight
+        with self.lock:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+
+            now = time.monotonic()
+            if now < self.next_adjustment:
+                return
+            self.next_adjustment = now + GOVERNOR_ADJUST_SECONDS
+            measured_rate = self.window_ops / (now - self.window_start)
+            self.window_start = now
+            self.window_ops = 0
+            if self.latency > self.threshold:
+                if self.rate is None:
+                    self.ceiling = max(self.min_rate, measured_rate)
+                    self.rate = self.ceiling
+                    self.next_slot = now
+                self.rate = max(self.min_rate, self.rate / 2)
+            elif self.rate is not None:
+                self.rate = min(self.ceiling, self.rate + self.ceiling / 10)
+                if self.max_rate is None and self.rate >= self.ceiling:
+                    self.rate = None
+
+    def run(self, operation, *args):
+        self.acquire()
+        start = time.perf_counter()
+        try:
+            return operation(*args)
+        finally:
+            self.record(time.perf_counter() - start)
+
+    def stats(self):
+        return {
+            "ops_per_second_limit": None if self.rate is None else round(self.rate, 1),
+            "latency_ms": round((self.latency or 0) * 1000, 2),
+            "throttled_seconds": round(self.throttled_seconds, 2)
+        }
+
+io_governor = IOGovernor(
+    EFS_MAX_OPS_PER_SECOND,
+    EFS_MIN_OPS_PER_SECOND,
+    EFS_LATENCY_THRESHOLD_MS
+)
+
+def list_directory(path):
+    with os.scandir(path) as entries:
+        return list(entries)
+
+# One scandir pass per directory. DirEntry.stat() is cached on the entry, so
+# the walker never issues a second os.stat round trip for the same file. A
+# listing's latency is spread over one operation per 512 entries returned.
+def scan_directory(path):
+    subdirs = []
+    files = []
+    try:
+        io_governor.acquire()
+        start = time.perf_counter()
+        entries = list_directory(path)
+        io_governor.record(
+            time.perf_counter() - start, 1 + len(entries) // 512
+        )
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.name.endswith(".gz"):
+                try:
+                    files.append((entry.path, io_governor.run(entry.stat)))
+                except FileNotFoundError:
+                    continue
+    except OSError as e:
+        print(f"Error listing {path}: {e}")
+    return path, subdirs, files
+
+def remove_file(path):
+    try:
+        io_governor.run(os.remove, path)
+        return path, None
+    except Exception as e:
+        return path, e
+
+def remove_directory(path):
+    try:
+        io_governor.run(os.rmdir, path)
+        return path, True
+    except OSError:
+        return path, False
+
+# The mount root is always kept. KEEP_DIRS lists further directories
+# (relative to EFS_MOUNT_PATH) to keep; without it every top-level
+# directory is kept.
+def is_kept_directory(path):
+    relative_path = os.path.relpath(path, EFS_MOUNT_PATH)
+    if relative_path == "." or relative_path.startswith(".."):
+        return True
+    if KEEP_DIRS:
+        return relative_path in KEEP_DIRS
+    return "/" not in relative_path
+
+# Removes directories emptied during this run deepest first, in batches,
+# then moves up to parents that became empty in turn. os.rmdir refuses a
+# directory that is not empty, so a file written concurrently keeps its
+# directory alive.
+def remove_empty_directories(executor, directories, should_stop):
+    removed = 0
+    pending = {path for path in directories if not is_kept_directory(path)}
+    while pending:
+        depth = max(path.count(os.sep) for path in pending)
+        level = sorted(path for path in pending if path.count(os.sep) == depth)
+        pending.difference_update(level)
+        for start in range(0, len(level), EMPTY_DIR_BATCH_SIZE):
+            if should_stop():
+                return removed
+            batch = level[start:start + EMPTY_DIR_BATCH_SIZE]
+            for path, was_removed in executor.map(remove_directory, batch):
+                if not was_removed:
+                    continue
+                removed += 1
+                parent = os.path.dirname(path)
+                if not is_kept_directory(parent):
+                    pending.add(parent)
+    return removed
+
+# Lists directories through a bounded thread pool and yields
+# (directory, [(path, stat), ...]) batches back to the caller's thread.
+# Directories that were queued or in flight when the walk stopped are put
+# back on the frontier.
+class ParallelWalker:
+    def __init__(self, executor, top, should_stop):
+        self.executor = executor
+        self.frontier = deque([top])
+        self.should_stop = should_stop
+        self.stopped = False
+
+    def walk(self):
+        listing = {}
+        try:
+            while self.frontier or listing:
+                if self.should_stop():
+                    self.stopped = True
+                    return
+                while self.frontier and len(listing) < WALKER_WORKERS:
+                    path = self.frontier.popleft()
+                    listing[self.executor.submit(scan_directory, path)] = path
+                done, _ = wait(listing, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del listing[future]
+                    path, subdirs, files = future.result()
+                    self.frontier.extend(subdirs)
+                    yield path, files
+        finally:
+            for future, path in listing.items():
+                future.cancel()
+                self.frontier.appendleft(path)
 
 def lambda_handler(event, context):
     now = time.time()
     retention_seconds = RETENTION_DAYS * 86400
 
-    inventory_key = get_latest_inventory_key()
-    s3_keys = load_inventory_keys(inventory_key)
+    # Candidates past retention are confirmed with concurrent HeadObject
+    # calls, a batch at a time during the walk, until there are more than
+    # HEAD_OBJECT_THRESHOLD of them. Past that the run switches to the
+    # inventory, which is only downloaded then.
+    s3_keys = None
+    candidates = []
+    candidate_count = 0
 
     deleted_count = 0
     skipped_count = 0
 
-    for root, _, files in os.walk(EFS_MOUNT_PATH):
-        for file in files:
-            if not file.endswith(".gz"):
-                continue
-
-            full_path = os.path.join(root, file)
-            age = now - os.stat(full_path).st_mtime
+    def should_stop():
+        return context.get_remaining_time_in_millis() / 1000 <= TIMEOUT_BUFFER_SECONDS
 
-            if age < retention_seconds:
+    def collect(removals):
+        nonlocal deleted_count, skipped_count
+        for future in removals:
+            full_path, error = future.result()
+            if error is None:
+                deleted_count += 1
+                if REMOVE_EMPTY_DIRS:
+                    emptied.add(os.path.dirname(full_path))
+                print(f"Deleted: {full_path}")
+            else:
                 skipped_count += 1
-                print(f"Skipped (too recent): {full_path}")
-                continue
+                print(f"Error deleting {full_path}: {error}")
 
-            s3_key = full_path.replace(EFS_MOUNT_PATH + "/", "")
+    def queue_removal(full_path):
+        nonlocal removals
+        removals.add(executor.submit(remove_file, full_path))
+        if len(removals) >= WALKER_WORKERS * 4:
+            done, removals = wait(removals, return_when=FIRST_COMPLETED)
+            collect(done)
 
-            if s3_key in s3_keys:
-                try:
-                    os.remove(full_path)
-                    deleted_count += 1
-                    print(f"Deleted: {full_path}")
-                except Exception as e:
-                    skipped_count += 1
-                    print(f"Error deleting {full_path}: {e}")
+    def check_inventory(full_path, s3_key):
+        nonlocal skipped_count
+        if s3_key in s3_keys:
+            queue_removal(full_path)
+        else:
+            skipped_count += 1
+            print(f"Skipped (not in inventory): {full_path}")
+
+    def verify_with_head_object():
+        nonlocal skipped_count, candidates
+        batch, candidates = candidates, []
+        reasons = head_executor.map(lambda c: head_object_check(c[1], c[2]), batch)
+        for (full_path, _, _), reason in zip(batch, reasons):
+            if reason is None:
+                queue_removal(full_path)
             else:
                 skipped_count += 1
-                print(f"Skipped (not in inventory): {full_path}")
+                print(f"Skipped ({reason}): {full_path}")
+
+    def should_stop_pruning():
+        remaining_time_seconds = context.get_remaining_time_in_millis() / 1000
+        return remaining_time_seconds <= TIMEOUT_BUFFER_SECONDS / 2
+
+    emptied = set()
+    empty_dirs_removed = 0
+    stopped = False
+    removals = set()
+    with ThreadPoolExecutor(max_workers=WALKER_WORKERS) as executor:
+        with ThreadPoolExecutor(max_workers=HEAD_OBJECT_WORKERS) as head_executor:
+            walker = ParallelWalker(executor, EFS_MOUNT_PATH, should_stop)
+            batches = walker.walk()
+
+            for _, files in batches:
+                for full_path, st in files:
+                    if should_stop():
+                        stopped = True
+                        break
+
+                    age = now - st.st_mtime
+
+                    if age < retention_seconds:
+                        skipped_count += 1
+                        print(f"Skipped (too recent): {full_path}")
+                        continue
+
+                    s3_key = full_path.replace(EFS_MOUNT_PATH + "/", "")
+
+                    if s3_keys is None:
+                        if candidate_count < HEAD_OBJECT_THRESHOLD:
+                            candidate_count += 1
+                            candidates.append((full_path, s3_key, st.st_size))
+                            if len(candidates) >= HEAD_OBJECT_WORKERS * 4:
+                                verify_with_head_object()
+                            continue
+                        print(f"More than {HEAD_OBJECT_THRESHOLD} candidates, verifying against the inventory")
+                        s3_keys = load_inventory_keys(get_latest_inventory_key())
+                        for path, key, _ in candidates:
+                            check_inventory(path, key)
+                        candidates = []
+
+                    check_inventory(full_path, s3_key)
+
+                if stopped:
+                    break
+
+            batches.close()
+            # The last partial batch still fits in the timeout buffer unless
+            # pruning would already be cut short; then it is only reported.
+            if candidates and should_stop_pruning():
+                skipped_count += len(candidates)
+                print(f"Skipped (no time for HeadObject): {len(candidates)} candidates")
+            elif candidates:
+                verify_with_head_object()
+            collect(wait(removals).done)
+            stopped = stopped or walker.stopped
+
+        if emptied:
+            empty_dirs_removed = remove_empty_directories(
+                executor, emptied, should_stop_pruning
+            )
+            print(f"Removed empty directories: {empty_dirs_removed}")
 
     print(f"Total deleted files: {deleted_count}")
     print(f"Total skipped files: {skipped_count}")
 
+    if stopped:
+        return {
+            "statusCode": 200,
+            "message": "Stopped early due to timeout buffer",
+            "deleted_count": deleted_count,
+            "skipped_count": skipped_count,
+            "empty_dirs_removed": empty_dirs_removed,
+            "verification": "head_object" if s3_keys is None else "inventory",
+            "io_governor": io_governor.stats()
+        }
+
     return {
         "statusCode": 200,
         "deleted_count": deleted_count,
-        "skipped_count": skipped_count
+        "skipped_count": skipped_count,
+        "empty_dirs_removed": empty_dirs_removed,
+        "verification": "head_object" if s3_keys is None else "inventory",
+        "io_governor": io_governor.stats()
     }